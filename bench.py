@@ -0,0 +1,649 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Metro Shop benchmarks
+Запуск: python bench.py <name> [...] [--save-baseline]   (без аргументов — список)
+
+BENCH_SCALE уменьшает/увеличивает синтетическую базу http-бенчмарка,
+BENCH_BASELINE — путь к файлу baseline (по умолчанию bench_baseline.json рядом).
+
+Baseline зависит от машины, поэтому в репозитории его нет: сначала снимите
+его на своём железе через --save-baseline, иначе регрессии не проверяются.
+Зависимости бенчмарков — requirements.txt (httpx нужен для http-бенчмарка).
+"""
+
+import os
+import sys
+import json
+import logging
+import time
+import asyncio
+import random
+import hmac
+import hashlib
+import itertools
+import tempfile
+from collections import Counter
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+WORKDIR = tempfile.mkdtemp(prefix='metro_bench_')
+os.environ.setdefault('DB_PATH', os.path.join(WORKDIR, 'metro_shop.db'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+BASELINE_PATH = os.getenv('BENCH_BASELINE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'bench_baseline.json'))
+BASELINE_TOLERANCE = float(os.getenv('BENCH_TOLERANCE', '0.2'))
+SAVE_BASELINE = '--save-baseline' in sys.argv
+
+import bot
+
+
+def fresh_db(name: str) -> 'bot.Database':
+    return bot.Database(os.path.join(WORKDIR, f'{name}.db'))
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'p50': 0, 'p95': 0, 'p99': 0}
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))]
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+
+def report(name: str, result: dict) -> dict:
+    print(json.dumps({'bench': name, **result}, ensure_ascii=False, indent=2))
+    return result
+
+
+def check_baseline(name: str, endpoints: dict) -> list:
+    """Сравнивает p95 по эндпоинтам с сохранённым baseline; --save-baseline перезаписывает его."""
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, encoding='utf-8') as f:
+            baselines = json.load(f)
+    if SAVE_BASELINE:
+        baselines[name] = endpoints
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2)
+        print(f'Baseline сохранён: {BASELINE_PATH}')
+        return []
+    if name not in baselines:
+        print(f'Baseline для {name} не найден ({BASELINE_PATH}) — регрессии не проверяются; '
+              f'снимите его: python bench.py {name} --save-baseline')
+        return []
+    regressions = []
+    for endpoint, base in baselines[name].items():
+        current = endpoints.get(endpoint)
+        if not current:
+            continue
+        # +1мс абсолютного запаса, чтобы не ловить шум на микросекундных ручках
+        limit = base['ms']['p95'] * (1 + BASELINE_TOLERANCE) + 1
+        if current['ms']['p95'] > limit:
+            regressions.append(f"{endpoint}: p95 {current['ms']['p95']}ms > {round(limit, 2)}ms "
+                               f"(baseline {base['ms']['p95']}ms)")
+    return regressions
+
+
+# ============== PROMO CODES ==============
+def bench_promo(users: int = 1000, limit: int = 100, threads: int = 64):
+    database = fresh_db('promo')
+    engine = bot.PromoEngine(database)
+    engine.create('VIRAL', 10, uses_total=limit, uses_per_user=1, max_discount=500)
+
+    n = 100_000
+    start = time.perf_counter()
+    for _ in range(n):
+        engine.quote('viral', 1500)
+    quote_us = (time.perf_counter() - start) / n * 1e6
+
+    def redeem(user_id):
+        t0 = time.perf_counter()
+        try:
+            engine.redeem('VIRAL', user_id, 1500)
+            ok = True
+        except bot.PromoError:
+            ok = False
+        return ok, (time.perf_counter() - t0) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(redeem, range(1, users + 1)))
+    elapsed = time.perf_counter() - start
+
+    redeemed = sum(1 for ok, _ in results if ok)
+    uses_count = database.fetchone('SELECT uses_count FROM promocodes WHERE code=?', ('VIRAL',))['uses_count']
+    uses_rows = database.fetchone('SELECT COUNT(*) as c FROM promocode_uses')['c']
+    assert redeemed == uses_count == uses_rows == limit, (redeemed, uses_count, uses_rows)
+
+    return report('promo', {
+        'quote_us': round(quote_us, 2),
+        'users': users,
+        'threads': threads,
+        'redeemed': redeemed,
+        'redeem_per_sec': round(users / elapsed, 1),
+        'redeem_ms': {k: round(v, 3) for k, v in percentiles([ms for _, ms in results]).items()},
+    })
+
+
+# ============== ORDER CLAIMS ==============
+def bench_claims(rounds=(10, 25, 50, 100), max_workers: int = 3):
+    database = fresh_db('claims')
+    queue = bot.OrderClaimQueue(database, window=bot.CLAIM_WINDOW_MS / 1000, max_workers=max_workers)
+
+    def new_order(number: str) -> int:
+        return database.execute('''
+            INSERT INTO orders (order_number, user_id, items, total, status, created_at, paid_at)
+            VALUES (?, 1, '[]', 1000, 'paid', ?, ?)
+        ''', (number, bot.now_iso(), bot.now_iso()))
+
+    # Исполнители 1..max_workers уже заняты — честная очередь должна отдать места другим
+    busy = new_order('busy')
+    for worker_id in range(1, max_workers + 1):
+        database.execute("INSERT INTO order_workers (order_id, worker_id, status) VALUES (?, ?, 'active')",
+                         (busy, worker_id))
+
+    async def tap(order_id, worker_id):
+        t0 = time.perf_counter()
+        result, _ = await queue.claim(order_id, worker_id, f'worker{worker_id}')
+        return worker_id, result, (time.perf_counter() - t0) * 1000
+
+    async def run():
+        out = {}
+        for n in rounds:
+            order_id = new_order(f'bench{n}')
+            taps = await asyncio.gather(*(tap(order_id, w) for w in range(1, n + 1)))
+            winners = sorted(w for w, result, _ in taps if result == 'ok')
+            assert len(winners) == min(n, max_workers), winners
+            if n > 2 * max_workers:
+                assert all(w > max_workers for w in winners), winners
+            taken = database.fetchone('SELECT COUNT(*) as c FROM order_workers WHERE order_id=?', (order_id,))['c']
+            assert taken == len(winners), taken
+            out[n] = {k: round(v, 2) for k, v in percentiles([ms for _, _, ms in taps]).items()}
+        return out
+
+    return report('claims', {'window_ms': bot.CLAIM_WINDOW_MS, 'latency_ms_by_tappers': asyncio.run(run())})
+
+
+# ============== CATALOG LISTINGS ==============
+def seed_products(database, count: int, categories: int = 10):
+    rng = random.Random(42)
+    conn = database.get_connection()
+    conn.executemany('''
+        INSERT INTO products (category_id, name, short_description, price, old_price, stock, is_featured,
+                              sold_count, views_count, rating, reviews_count, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, -1, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        (1 + i % categories, f'Товар {i}', 'Описание', rng.randint(50, 50000), None, int(rng.random() < 0.05),
+         rng.randint(0, 5000), rng.randint(0, 100000), round(rng.uniform(0, 5), 1), rng.randint(0, 300),
+         f'2025-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:00:00', None)
+        for i in range(count)
+    ))
+    conn.commit()
+    conn.close()
+
+
+def bench_catalog(products: int = 100_000, queries: int = 2000):
+    database = fresh_db('catalog')
+    seed_products(database, products)
+    index = bot.CatalogIndex(database)
+
+    t0 = time.perf_counter()
+    index.reload()
+    build_s = time.perf_counter() - t0
+
+    order_by = {
+        'popular': 'sold_count DESC, is_featured DESC',
+        'price_asc': 'price ASC',
+        'price_desc': 'price DESC',
+        'new': 'created_at DESC',
+        'rating': 'rating DESC',
+    }
+    rng = random.Random(1)
+    cases = [(rng.choice([None] + list(range(1, 11))), rng.choice(list(order_by)), rng.choice([0, 0, 20, 200]))
+             for _ in range(queries)]
+
+    def run(fn):
+        samples = []
+        for category_id, sort, offset in cases:
+            t = time.perf_counter()
+            fn(category_id, sort, offset)
+            samples.append((time.perf_counter() - t) * 1000)
+        return {k: round(v, 3) for k, v in percentiles(samples).items()}
+
+    def sql(category_id, sort, offset):
+        query = 'SELECT * FROM products WHERE is_active=1'
+        params = ()
+        if category_id:
+            query += ' AND category_id=?'
+            params = (category_id,)
+        rows = database.fetchall(f'{query} ORDER BY {order_by[sort]} LIMIT 20 OFFSET {offset}', params)
+        return [bot.parse_product(r) for r in rows]
+
+    memory = run(lambda c, s, o: index.list(c, s, 20, o))
+    sql_ms = run(sql)
+
+    # Инкрементальные изменения: цена/продажи меняются у случайных товаров
+    updates = 1000
+    t0 = time.perf_counter()
+    for _ in range(updates):
+        row = dict(index.get(rng.randint(1, products)) or {})
+        if not row:
+            continue
+        row.update(price=rng.randint(50, 50000), sold_count=row['sold_count'] + 1,
+                   photos='[]', tags='[]', meta='{}')
+        index.upsert(row)
+    update_us = (time.perf_counter() - t0) / updates * 1e6
+
+    page = index.list(None, 'price_asc', 50, 0)
+    assert [p['price'] for p in page] == sorted(p['price'] for p in page)
+
+    return report('catalog', {
+        'products': products,
+        'build_s': round(build_s, 2),
+        'list_ms_memory': memory,
+        'list_ms_sql': sql_ms,
+        'update_us': round(update_us, 1),
+    })
+
+
+# ============== BOT UPDATE CONCURRENCY ==============
+def synthetic_update(update_id: int, user_id: int):
+    from datetime import datetime, timezone
+    from telegram import Chat, Message, Update, User
+    user = User(user_id, f'user{user_id}', False)
+    return Update(update_id, message=Message(update_id, datetime.now(timezone.utc), Chat(user_id, 'private'),
+                                             from_user=user, text='🛒 Корзина'))
+
+
+def synthetic_claim_update(update_id: int, user_id: int, chat_id: int = -100):
+    """Нажатие «Взять заказ» в общем групповом чате исполнителей."""
+    from datetime import datetime, timezone
+    from telegram import CallbackQuery, Chat, Message, Update, User
+    message = Message(1, datetime.now(timezone.utc), Chat(chat_id, 'supergroup'), text='Новый заказ')
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), User(user_id, f'worker{user_id}', False),
+                                                          'bench', message=message, data='claim:1'))
+
+
+def bench_updates(users: int = 200, per_user: int = 10, handler_ms: float = 20, limit: int = None):
+    limit = limit or bot.BOT_CONCURRENT_UPDATES
+    rng = random.Random(7)
+    # Апдейты пользователей вперемешку, но внутри пользователя — по возрастанию seq
+    order = [u for u in range(1, users + 1) for _ in range(per_user)]
+    rng.shuffle(order)
+    seq = {}
+    updates = []
+    for update_id, user_id in enumerate(order):
+        seq[user_id] = seq.get(user_id, 0) + 1
+        updates.append((synthetic_update(update_id, user_id), seq[user_id]))
+
+    async def run(processor):
+        seen = {}
+        running = peak = 0
+        latencies = []
+
+        async def handle(user_id, n, queued_at):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            seen.setdefault(user_id, []).append(n)
+            await asyncio.sleep(handler_ms / 1000 * rng.uniform(0.5, 1.5))
+            running -= 1
+            latencies.append((time.perf_counter() - queued_at) * 1000)
+
+        t0 = time.perf_counter()
+        # Как Application._update_fetcher: по задаче на апдейт в порядке поступления
+        tasks = [asyncio.create_task(processor.process_update(
+            update, handle(update.effective_user.id, n, time.perf_counter()))) for update, n in updates]
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - t0
+
+        assert all(ns == sorted(ns) for ns in seen.values()), 'нарушен порядок апдейтов пользователя'
+        assert peak <= processor.limit, peak
+        return {
+            'updates_per_sec': round(len(updates) / elapsed, 1),
+            'peak_concurrency': peak,
+            'latency_ms': {k: round(v, 1) for k, v in percentiles(latencies).items()},
+        }
+
+    async def group_claims(processor, workers: int = 20):
+        # Каждое нажатие ждёт окно OrderClaimQueue; разные исполнители должны попасть в одно окно
+        window = bot.CLAIM_WINDOW_MS / 1000
+
+        async def handle():
+            await asyncio.sleep(window)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(processor.process_update(synthetic_claim_update(i, 1000 + i), handle())
+                               for i in range(workers)))
+        elapsed = time.perf_counter() - t0
+        assert elapsed < window * 2, f'нажатия в общем чате сериализованы: {elapsed:.2f}s'
+        return {'workers': workers, 'window_ms': bot.CLAIM_WINDOW_MS, 'elapsed_ms': round(elapsed * 1000, 1)}
+
+    sequential = bot.PerUserUpdateProcessor(1)
+    concurrent = bot.PerUserUpdateProcessor(limit)
+    return report('updates', {
+        'updates': len(updates),
+        'users': users,
+        'handler_ms': handler_ms,
+        'sequential': asyncio.run(run(sequential)),
+        f'concurrent_{limit}': asyncio.run(run(concurrent)),
+        'group_claims': asyncio.run(group_claims(bot.PerUserUpdateProcessor(limit))),
+    })
+
+
+# ============== CATALOG IMPORT ==============
+def bench_import(rows: int = 100_000, categories: int = 50):
+    import csv
+    database = fresh_db('import')
+    path = os.path.join(WORKDIR, 'catalog.csv')
+    rng = random.Random(9)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['name', 'category', 'price', 'old_price', 'stock', 'short_description', 'tags'])
+        for i in range(rows):
+            writer.writerow([f'Товар {i}', f'Поставщик {i % categories}', rng.randint(50, 50000), '',
+                             rng.choice(['', '-1', '10']), 'Описание', 'pubg, uc'])
+
+    def run():
+        t0 = time.perf_counter()
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            stats = bot.import_catalog(stream, 'csv', database=database)
+        return stats, time.perf_counter() - t0
+
+    first, first_s = run()
+    assert first['inserted'] == rows and first['categories_created'] == categories, first
+    # Повторный прогон того же файла — только обновления
+    second, second_s = run()
+    assert second['updated'] == rows and second['inserted'] == 0, second
+    count = database.fetchone('SELECT COUNT(*) as c FROM products')['c']
+    assert count == rows, count
+
+    return report('import', {
+        'rows': rows,
+        'insert_s': round(first_s, 2),
+        'insert_rows_per_sec': round(rows / first_s),
+        'update_s': round(second_s, 2),
+        'update_rows_per_sec': round(rows / second_s),
+    })
+
+
+# ============== WEBAPP HTTP API ==============
+def require_empty_shared_db():
+    # Эндпоинты и хендлеры работают с глобальным bot.db, поэтому http и bot сеют его каждый под себя
+    if bot.db.fetchone('SELECT 1 FROM products LIMIT 1'):
+        sys.exit('http и bot заполняют общую bot.db — запускайте их отдельными процессами')
+
+
+def sign_init_data(tg_id: int) -> str:
+    fields = {'auth_date': str(int(time.time())), 'query_id': f'bench{tg_id}',
+              'user': json.dumps({'id': tg_id, 'first_name': f'User{tg_id}'}, separators=(',', ':'))}
+    data_check_string = '\n'.join(f'{k}={v}' for k, v in sorted(fields.items()))
+    secret_key = hmac.new(b'WebAppData', bot.TG_BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def seed_users(database, users: int, cart_rows: int, favorite_rows: int, products: int):
+    """Пользователи с tg_id = 10**9 + id; у каждого по несколько разных товаров в корзине и избранном."""
+    conn = database.get_connection()
+    conn.executemany('INSERT INTO users (tg_id, username, first_name, registered_at, balance) VALUES (?, ?, ?, ?, ?)', (
+        (10 ** 9 + i, f'user{i}', f'User{i}', '2025-01-01T00:00:00', (i % 7) * 10) for i in range(1, users + 1)
+    ))
+
+    def pairs(rows: int, salt: int):
+        per_user = rows / users
+        for user_id in range(1, users + 1):
+            count = int(user_id * per_user) - int((user_id - 1) * per_user)
+            for slot in range(count):
+                yield user_id, (user_id * salt + slot * 997) % products + 1
+
+    conn.executemany('INSERT OR IGNORE INTO cart (user_id, product_id, quantity, added_at) VALUES (?, ?, ?, ?)',
+                     ((u, p, 1 + p % 3, '2025-01-01T00:00:00') for u, p in pairs(cart_rows, 31)))
+    conn.executemany('INSERT OR IGNORE INTO favorites (user_id, product_id, added_at) VALUES (?, ?, ?)',
+                     ((u, p, '2025-01-01T00:00:00') for u, p in pairs(favorite_rows, 61)))
+    conn.commit()
+    conn.close()
+
+
+def bench_http(requests_per_endpoint: int = 2000, concurrency: int = 32, sessions: int = 2000):
+    import httpx
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    scale = float(os.getenv('BENCH_SCALE', '1'))
+    products, users = int(100_000 * scale), int(1_000_000 * scale)
+    cart_rows = favorite_rows = int(2_500_000 * scale)
+
+    require_empty_shared_db()
+    t0 = time.perf_counter()
+    seed_products(bot.db, products)
+    seed_users(bot.db, users, cart_rows, favorite_rows, products)
+    bot.catalog_index.reload()
+    bot.bump_catalog_version()
+    seed_s = time.perf_counter() - t0
+
+    rng = random.Random(3)
+    tg_ids = [10 ** 9 + rng.randint(1, users) for _ in range(sessions)]
+    headers = {tg_id: {'X-Telegram-Init-Data': sign_init_data(tg_id)} for tg_id in tg_ids}
+    sorts = ['popular', 'price_asc', 'price_desc', 'new', 'rating']
+    product_id = lambda: rng.randint(1, products)
+
+    scenarios = {
+        'GET /api/products': lambda: ('GET', '/api/products', {'params': {
+            'sort': rng.choice(sorts), 'offset': rng.choice([0, 0, 20, 200]),
+            **({'category_id': rng.randint(1, 10)} if rng.random() < 0.7 else {})}}),
+        'GET /api/products?search': lambda: ('GET', '/api/products', {'params': {
+            'search': f'Товар {rng.randint(1, 999)}'}}),
+        'GET /api/products/{id}': lambda: ('GET', f'/api/products/{product_id()}', {}),
+        'GET /api/cart': lambda: ('GET', '/api/cart', {}),
+        'POST /api/cart/add': lambda: ('POST', '/api/cart/add', {'json': {'product_id': product_id()}}),
+        'POST /api/cart/update': lambda: ('POST', '/api/cart/update', {'json': {
+            'product_id': product_id(), 'quantity': rng.randint(0, 3)}}),
+        'DELETE /api/cart/{id}': lambda: ('DELETE', f'/api/cart/{product_id()}', {}),
+        'GET /api/favorites': lambda: ('GET', '/api/favorites', {}),
+        'POST /api/favorites/{id}': lambda: ('POST', f'/api/favorites/{product_id()}', {}),
+    }
+
+    async def run_endpoint(client, make):
+        samples, errors = [], 0
+        queue = asyncio.Queue()
+        for _ in range(requests_per_endpoint):
+            queue.put_nowait(make())
+
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                method, url, kwargs = queue.get_nowait()
+                t = time.perf_counter()
+                response = await client.request(method, url, headers=headers[rng.choice(tg_ids)], **kwargs)
+                samples.append((time.perf_counter() - t) * 1000)
+                errors += response.status_code >= 400
+
+        t = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t
+        return {
+            'rps': round(len(samples) / elapsed, 1),
+            'errors': errors,
+            'ms': {k: round(v, 3) for k, v in percentiles(samples).items()},
+        }
+
+    async def run():
+        transport = httpx.ASGITransport(app=bot.webapp)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            # Прогрев: кэш проверенных initData, страницы SQLite
+            await asyncio.gather(*(client.get('/api/cart', headers=h) for h in headers.values()))
+            return {name: await run_endpoint(client, make) for name, make in scenarios.items()}
+
+    endpoints = asyncio.run(run())
+    regressions = check_baseline('http', endpoints)
+    report('http', {
+        'products': products, 'users': users, 'cart_rows': cart_rows, 'favorite_rows': favorite_rows,
+        'seed_s': round(seed_s, 1), 'concurrency': concurrency,
+        'endpoints': endpoints,
+        'regressions': regressions,
+    })
+    if regressions:
+        sys.exit(1)
+
+
+# ============== BOT HANDLERS ==============
+from telegram.request import BaseRequest
+
+
+class FakeBotAPI(BaseRequest):
+    """Подмена HTTP-слоя PTB: отвечает как Bot API, считает вызовы, добавляет задержку и 429."""
+
+    def __init__(self, latency_ms=(20, 60), flood_rate: float = 0.0, seed: int = 5):
+        self.latency_ms = latency_ms
+        self.flood_rate = flood_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.flood = 0
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        await asyncio.sleep(self.rng.uniform(*self.latency_ms) / 1000)
+        params = request_data.parameters if request_data else {}
+        if api_method != 'getMe' and self.rng.random() < self.flood_rate:
+            self.flood += 1
+            return 429, json.dumps({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                    'parameters': {'retry_after': 1}}).encode()
+        return 200, json.dumps({'ok': True, 'result': self._result(api_method, params)}).encode()
+
+    def _result(self, api_method: str, params: dict):
+        if api_method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Metro Shop', 'username': 'metro_bench_bot'}
+        if api_method.startswith(('send', 'edit', 'copy', 'forward')):
+            def message():
+                return {'message_id': int(params.get('message_id') or next(self._message_ids)),
+                        'date': int(time.time()), 'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                        'text': params.get('text') or params.get('caption') or ''}
+            if api_method == 'sendMediaGroup':
+                media = params.get('media') or []
+                return [message() for _ in (json.loads(media) if isinstance(media, str) else media)]
+            return message()
+        return True
+
+
+def synthetic_bot_update(update_id: int, tg_id: int, kind: str, payload: str) -> dict:
+    user = {'id': tg_id, 'is_bot': False, 'first_name': f'User{tg_id}'}
+    chat = {'id': tg_id, 'type': 'private'}
+    now = int(time.time())
+    if kind == 'message':
+        message = {'message_id': update_id, 'date': now, 'chat': chat, 'from': user, 'text': payload}
+        if payload.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(payload.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': 'bench', 'data': payload,
+        'message': {'message_id': 1, 'date': now, 'chat': chat, 'text': 'Metro Shop',
+                    'from': {'id': 1, 'is_bot': True, 'first_name': 'Metro Shop'}},
+    }}
+
+
+def bench_bot(updates: int = 5000, users: int = 500, latency_ms=(20, 60), flood_rate: float = 0.01):
+    from telegram import Update
+
+    require_empty_shared_db()
+    categories, per_category = 10, 10
+    conn = bot.db.get_connection()
+    conn.executemany('INSERT OR IGNORE INTO categories (id, name, emoji, is_active) VALUES (?, ?, ?, 1)',
+                     ((i, f'Категория {i}', '📦') for i in range(1, categories + 1)))
+    conn.commit()
+    conn.close()
+    seed_products(bot.db, categories * per_category, categories)
+    seed_users(bot.db, users, users * 2, users, categories * per_category)
+    bot.catalog_index.reload()
+    bot.bump_catalog_version()
+
+    rng = random.Random(11)
+    products = categories * per_category
+    mix = [
+        (0.10, lambda: ('message', '/start')),
+        (0.15, lambda: ('message', '🛒 Корзина')),
+        (0.25, lambda: ('callback', f'cat:{rng.randint(1, categories)}')),
+        (0.30, lambda: ('callback', f'product:{rng.randint(1, products)}')),
+        (0.20, lambda: ('callback', f'cart_{rng.choice(["plus", "minus"])}:{rng.randint(1, products)}')),
+    ]
+
+    def pick():
+        r = rng.random()
+        for weight, make in mix:
+            if r < weight:
+                return make()
+            r -= weight
+        return mix[-1][1]()
+
+    fake = FakeBotAPI(latency_ms, flood_rate)
+    app = bot.build_bot_app(request=fake, get_updates_request=FakeBotAPI(latency_ms))
+    errors = Counter()
+
+    async def on_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    app.add_error_handler(on_error)
+    kinds = Counter()
+
+    async def run():
+        await app.initialize()
+        await app.start()
+        fake.calls.clear()
+        t0 = time.perf_counter()
+        for update_id in range(1, updates + 1):
+            kind, payload = pick()
+            kinds[payload.split(':')[0]] += 1
+            data = synthetic_bot_update(update_id, 10 ** 9 + rng.randint(1, users), kind, payload)
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await app.update_queue.join()
+        elapsed = time.perf_counter() - t0
+        await asyncio.sleep(bot.CART_DEBOUNCE_MS / 1000 + 0.2)  # дописать отложенные правки корзины
+        await app.stop()
+        await app.shutdown()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    total_calls = sum(fake.calls.values())
+    return report('bot', {
+        'updates': updates,
+        'users': users,
+        'concurrency': bot.BOT_CONCURRENT_UPDATES,
+        'api_latency_ms': list(latency_ms),
+        'updates_per_sec': round(updates / elapsed, 1),
+        'telegram_calls_per_update': round(total_calls / updates, 2),
+        'telegram_calls': dict(fake.calls.most_common()),
+        'updates_by_kind': dict(kinds),
+        'flood_429': fake.flood,
+        'handler_errors': dict(errors),
+    })
+
+
+BENCHMARKS = {
+    'promo': bench_promo,
+    'claims': bench_claims,
+    'catalog': bench_catalog,
+    'updates': bench_updates,
+    'import': bench_import,
+    'http': bench_http,
+    'bot': bench_bot,
+}
+
+
+if __name__ == '__main__':
+    names = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not names:
+        print('Доступные бенчмарки:', ', '.join(BENCHMARKS))
+        sys.exit(0)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f'Неизвестный бенчмарк: {name}')
+        BENCHMARKS[name]()
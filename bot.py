@@ -6,15 +6,37 @@ Metro Shop Telegram Bot + WebApp Server - All-in-One
 """
 
 import os
+import sys
+import copy
+import atexit
+import io
+import csv
+import gzip
+import time
 import sqlite3
 import logging
 import json
 import hashlib
 import hmac
+import shutil
+import secrets
+import tempfile
 import threading
+import traceback
+import re
+import math
 import asyncio
+import functools
+import itertools
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from queue import SimpleQueue
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Iterator
 from urllib.parse import parse_qsl
 
 # ============== CONFIGURATION ==============
@@ -33,23 +55,176 @@ ADMIN_IDS = [OWNER_ID]
 if os.getenv('ADMIN_IDS'):
     ADMIN_IDS = [int(x) for x in os.getenv('ADMIN_IDS').split(',') if x.strip()]
 
+# Исполнители, которым разрешено брать заказы (админы могут всегда)
+WORKER_IDS = [int(x) for x in os.getenv('WORKER_IDS', '').split(',') if x.strip()]
+
 MAX_WORKERS_PER_ORDER = int(os.getenv('MAX_WORKERS_PER_ORDER', '3'))
 WORKER_PERCENT = float(os.getenv('WORKER_PERCENT', '0.7'))
+CLAIM_WINDOW_MS = int(os.getenv('CLAIM_WINDOW_MS', '300'))
 REFERRAL_PERCENT = float(os.getenv('REFERRAL_PERCENT', '0.05'))
+REFERRAL_ACCRUAL_INTERVAL = int(os.getenv('REFERRAL_ACCRUAL_INTERVAL', '300'))
+REFERRAL_BATCH_SIZE = int(os.getenv('REFERRAL_BATCH_SIZE', '1000'))
+PAYOUT_SETTLEMENT_INTERVAL = int(os.getenv('PAYOUT_SETTLEMENT_INTERVAL', '600'))
+
+ANALYTICS_ROLLUP_INTERVAL = int(os.getenv('ANALYTICS_ROLLUP_INTERVAL', '300'))
+ANALYTICS_COMPACT_INTERVAL = int(os.getenv('ANALYTICS_COMPACT_INTERVAL', '3600'))
+ANALYTICS_RETENTION_DAYS = int(os.getenv('ANALYTICS_RETENTION_DAYS', '90'))
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', '5000'))
+ANALYTICS_VACUUM_PAGES = int(os.getenv('ANALYTICS_VACUUM_PAGES', '1000'))
+ANALYTICS_ARCHIVE_DIR = os.getenv('ANALYTICS_ARCHIVE_DIR', '')
+
+SSE_HEARTBEAT_SECONDS = int(os.getenv('SSE_HEARTBEAT_SECONDS', '25'))
+SSE_TOKEN_TTL = int(os.getenv('SSE_TOKEN_TTL', '60'))
+INIT_DATA_MAX_AGE = int(os.getenv('INIT_DATA_MAX_AGE', '86400'))
+SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', '100'))
+BOOTSTRAP_CACHE_TTL = int(os.getenv('BOOTSTRAP_CACHE_TTL', '30'))
+CATALOG_RELOAD_INTERVAL = int(os.getenv('CATALOG_RELOAD_INTERVAL', '600'))
+CATALOG_IMPORT_BATCH = int(os.getenv('CATALOG_IMPORT_BATCH', '2000'))
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', '21600'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_COMPRESS = os.getenv('BACKUP_COMPRESS', '1') == '1'
+BACKUP_STEP_PAGES = int(os.getenv('BACKUP_STEP_PAGES', '256'))
+BACKUP_STEP_SLEEP = float(os.getenv('BACKUP_STEP_SLEEP', '0.02'))
+BACKUP_MAX_RESTARTS = int(os.getenv('BACKUP_MAX_RESTARTS', '5'))
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '1000'))
+EXPORT_PART_MB = int(os.getenv('EXPORT_PART_MB', '20'))
+RENDER_CACHE_TTL = int(os.getenv('RENDER_CACHE_TTL', '300'))
+CART_DEBOUNCE_MS = int(os.getenv('CART_DEBOUNCE_MS', '400'))
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '32'))
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+QUERY_PROFILER_ENABLED = os.getenv('QUERY_PROFILER_ENABLED', '1') == '1'
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+LOOP_WATCHDOG_ENABLED = os.getenv('LOOP_WATCHDOG_ENABLED', '1') == '1'
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+LOOP_STALL_SECONDS = float(os.getenv('LOOP_STALL_SECONDS', '0.25'))
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_READ = (float(os.getenv('RATE_LIMIT_READ_RPS', '20')), int(os.getenv('RATE_LIMIT_READ_BURST', '40')))
+RATE_LIMIT_WRITE = (float(os.getenv('RATE_LIMIT_WRITE_RPS', '5')), int(os.getenv('RATE_LIMIT_WRITE_BURST', '15')))
+# Адреса обратных прокси, которым доверяем X-Forwarded-For / X-Real-IP
+TRUSTED_PROXIES = {x.strip() for x in os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if x.strip()}
+RATE_LIMIT_BOT = (float(os.getenv('RATE_LIMIT_BOT_RPS', '3')), int(os.getenv('RATE_LIMIT_BOT_BURST', '10')))
+
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_JSON = os.getenv('LOG_FORMAT', 'text') == 'json'
+LOG_MAX_MB = int(os.getenv('LOG_MAX_MB', '20'))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')  # например 'midnight' — ротация по времени вместо размера
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', 'httpx=0.01,uvicorn.access=0.1')
 
 PAYMENT_CARD = "+79002535363"
 PAYMENT_HOLDER = "Николай М"
 PAYMENT_BANK = "Сбербанк"
 
 # ============== LOGGING ==============
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+# request_id / user_id / update_id текущего HTTP-запроса или апдейта бота
+log_context: ContextVar[Dict] = ContextVar('log_context', default={})
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in log_context.get().items():
+            setattr(record, key, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Из болтливых логгеров пропускает каждую N-ю запись ниже WARNING (N = 1/rate)."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.every = {name: max(1, round(1 / rate)) for name, rate in rates.items() if rate > 0}
+        self.muted = {name for name, rate in rates.items() if rate <= 0}
+        self._counters: Dict[str, Any] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        name = record.name
+        while name not in self.every and name not in self.muted and '.' in name:
+            name = name.rsplit('.', 1)[0]
+        if name in self.muted:
+            return False
+        every = self.every.get(name)
+        if every is None:
+            return True
+        counter = self._counters.get(name)
+        if counter is None:
+            counter = self._counters.setdefault(name, itertools.count())
+        return next(counter) % every == 0
+
+    @staticmethod
+    def parse(spec: str) -> Dict[str, float]:
+        rates = {}
+        for item in filter(None, (part.strip() for part in spec.split(','))):
+            name, _, rate = item.partition('=')
+            rates[name.strip()] = float(rate)
+        return rates
+
+class JsonFormatter(logging.Formatter):
+    CONTEXT_FIELDS = ('request_id', 'user_id', 'update_id', 'route')
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key in self.CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class LogQueueHandler(QueueHandler):
+    """Кладёт запись в очередь; форматирует и пишет на диск поток QueueListener.
+
+    В вызывающем потоке остаётся только подстановка аргументов (объекты могут
+    измениться, пока запись лежит в очереди) и текст трейсбека.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging() -> QueueListener:
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS,
+                                                encoding='utf-8')
+    else:
+        file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_MB * 1024 * 1024, backupCount=LOG_BACKUPS,
+                                           encoding='utf-8')
+    handlers = [file_handler, logging.StreamHandler()]
+    formatter = JsonFormatter() if LOG_JSON else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(SamplingFilter.parse(LOG_SAMPLE)))
+    queue_handler.addFilter(LogContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # ============== HELPER FUNCTIONS ==============
@@ -63,7 +238,26 @@ def generate_order_number() -> str:
 def is_admin(tg_id: int) -> bool:
     return tg_id in ADMIN_IDS
 
+def is_worker(tg_id: int) -> bool:
+    return tg_id in WORKER_IDS or is_admin(tg_id)
+
+# Проверенные initData → (user, auth_date); позволяет опознать пользователя без повторного HMAC
+_validated_init_data: 'OrderedDict[str, Tuple[Dict, int]]' = OrderedDict()
+_VALIDATED_INIT_DATA_MAX = 10000
+
+def _init_data_expired(auth_date: int) -> bool:
+    return INIT_DATA_MAX_AGE > 0 and time.time() - auth_date > INIT_DATA_MAX_AGE
+
+def cached_webapp_user(init_data: str) -> Optional[Dict]:
+    entry = _validated_init_data.get(init_data) if init_data else None
+    if entry is None or _init_data_expired(entry[1]):
+        return None
+    return entry[0]
+
 def validate_webapp_data(init_data: str) -> Optional[Dict]:
+    user = cached_webapp_user(init_data)
+    if user is not None:
+        return user
     try:
         parsed = dict(parse_qsl(init_data, keep_blank_values=True))
         received_hash = parsed.pop('hash', '')
@@ -71,20 +265,368 @@ def validate_webapp_data(init_data: str) -> Optional[Dict]:
         secret_key = hmac.new(b'WebAppData', TG_BOT_TOKEN.encode(), hashlib.sha256).digest()
         calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
         if hmac.compare_digest(calculated_hash, received_hash):
-            return json.loads(parsed.get('user', '{}'))
+            # initData — бессрочная подпись, поэтому ограничиваем её возраст по auth_date
+            auth_date = int(parsed.get('auth_date') or 0)
+            if _init_data_expired(auth_date):
+                return None
+            user = json.loads(parsed.get('user', '{}'))
+            _validated_init_data[init_data] = (user, auth_date)
+            while len(_validated_init_data) > _VALIDATED_INIT_DATA_MAX:
+                _validated_init_data.popitem(last=False)
+            return user
         return None
     except Exception as e:
-        logger.error(f"WebApp validation error: {e}")
+        logger.error("WebApp validation error: %s", e)
         return None
 
+# ============== METRICS ==============
+class Metrics:
+    """Счётчики и гистограммы в формате Prometheus.
+
+    Каждый поток пишет в свой шард (threading.local), поэтому горячий путь —
+    это поиск в dict и сложение без блокировок; шарды суммируются только при
+    отдаче /metrics. Значения, которые и так хранятся в объектах (кэши,
+    очереди), снимаются коллекторами в момент экспорта.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[Dict] = []
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {}
+        self._collectors = []
+
+    def declare(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = ()) -> None:
+        self._meta[name] = (kind, help_text, tuple(buckets))
+
+    def collector(self, func):
+        """func() -> [(name, labels, value)] для уже объявленных метрик.
+
+        Повторная регистрация функции с тем же именем заменяет прежнюю —
+        build_bot_app может вызываться несколько раз за процесс.
+        """
+        self._collectors = [c for c in self._collectors if c.__qualname__ != func.__qualname__] + [func]
+        return func
+
+    def _shard(self) -> Dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        shard = self._shard()
+        cell = shard.get((name, labels))
+        if cell is None:
+            cell = shard[(name, labels)] = [0]
+        cell[0] += value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        shard = self._shard()
+        cell = shard.get((name, labels))
+        if cell is None:
+            # счётчики по корзинам, +Inf, сумма
+            cell = shard[(name, labels)] = [0] * (len(self._meta[name][2]) + 2)
+        cell[bisect_left(self._meta[name][2], value)] += 1
+        cell[-1] += value
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = tuple(labels) + extra
+        if not pairs:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self) -> str:
+        merged: Dict[Tuple[str, tuple], List[float]] = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, cell in list(shard.items()):
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = list(cell)
+                else:
+                    for i, value in enumerate(cell):
+                        total[i] += value
+        for func in self._collectors:
+            try:
+                for name, labels, value in func():
+                    merged[(name, tuple(labels))] = [value]
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", func.__name__, e)
+
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            series = sorted((labels, cell) for (n, labels), cell in merged.items() if n == name)
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, cell in series:
+                if kind != 'histogram':
+                    lines.append(f'{name}{self._labels(labels)} {cell[0]:g}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), cell[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{name}_bucket{self._labels(labels, (("le", le),))} {cumulative:g}')
+                lines.append(f'{name}_sum{self._labels(labels)} {cell[-1]:.6f}')
+                lines.append(f'{name}_count{self._labels(labels)} {cumulative:g}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+metrics.declare('metro_http_requests_total', 'counter', 'HTTP-запросы по маршруту, методу и статусу')
+metrics.declare('metro_http_request_duration_seconds', 'histogram', 'Время ответа HTTP', LATENCY_BUCKETS)
+metrics.declare('metro_http_db_queries_total', 'counter', 'SQL-запросы, выполненные внутри HTTP-запросов')
+metrics.declare('metro_http_db_seconds_total', 'counter', 'Время SQL внутри HTTP-запросов')
+metrics.declare('metro_bot_handler_duration_seconds', 'histogram', 'Время хендлеров бота', LATENCY_BUCKETS)
+metrics.declare('metro_bot_handler_calls_total', 'counter', 'Вызовы хендлеров бота по результату')
+metrics.declare('metro_bot_handler_db_queries_total', 'counter', 'SQL-запросы внутри хендлеров бота')
+metrics.declare('metro_db_query_duration_seconds', 'histogram', 'Время выполнения SQL', DB_BUCKETS)
+metrics.declare('metro_db_transaction_seconds', 'histogram',
+                'BEGIN/COMMIT/ROLLBACK: в основном ожидание блокировки записи и fsync', LATENCY_BUCKETS)
+metrics.declare('metro_cache_requests_total', 'counter', 'Обращения к кэшам: hit/miss')
+metrics.declare('metro_rate_limit_total', 'counter', 'Решения лимитера частоты')
+metrics.declare('metro_queue_depth', 'gauge', 'Глубина внутренних очередей')
+metrics.declare('metro_sse_connections', 'gauge', 'Открытые SSE-подключения')
+metrics.declare('metro_backup_last_timestamp_seconds', 'gauge', 'Время окончания последнего бэкапа (unix)')
+metrics.declare('metro_backup_duration_seconds', 'gauge', 'Длительность последнего бэкапа')
+metrics.declare('metro_backup_size_bytes', 'gauge', 'Размер последнего снимка')
+metrics.declare('metro_loop_lag_seconds', 'histogram', 'Задержка планирования event loop',
+                (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+metrics.declare('metro_loop_stalls_total', 'counter', 'Блокировки event loop дольше порога')
+
+# [число запросов, секунды] SQL текущего HTTP-запроса или хендлера бота
+_query_stats: ContextVar[Optional[List[float]]] = ContextVar('query_stats', default=None)
+
+_TRANSACTION_CONTROL = ('BEGIN', 'COMMIT', 'END', 'ROLLBACK')
+
+def record_query(cursor: sqlite3.Cursor, sql: str, params, elapsed: float) -> None:
+    verb = sql.lstrip()[:8].upper()
+    if verb.startswith(_TRANSACTION_CONTROL):
+        # Ожидание BEGIN IMMEDIATE — не медленный запрос; в профилировщике оно заслоняло бы настоящие
+        metrics.observe('metro_db_transaction_seconds', (('statement', verb.split()[0]),), elapsed)
+    else:
+        metrics.observe('metro_db_query_duration_seconds', (), elapsed)
+        if query_profiler.enabled:
+            query_profiler.record(cursor, sql, params, elapsed)
+    stats = _query_stats.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(self, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(self, sql, None, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_query(self, sql_script, None, time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute* создают курсор в C в обход cursor() — перенаправляем явно
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+# ============== QUERY PROFILER ==============
+class QueryProfiler:
+    """Статистика SQL по нормализованной форме запроса: число, суммарное время, p99.
+
+    Запросы дольше slow_ms пишутся в лог вместе с EXPLAIN QUERY PLAN (план
+    снимается не чаще раза в plan_ttl секунд на форму). enabled=False
+    выключает всё, кроме одной проверки флага.
+    """
+
+    _LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    _LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+    _SPACES = re.compile(r"\s+")
+
+    def __init__(self, enabled: bool = True, slow_ms: float = 100, samples: int = 512,
+                 plan_ttl: float = 600, max_shapes: int = 2000):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.samples = samples
+        self.plan_ttl = plan_ttl
+        self.max_shapes = max_shapes
+        self._shapes: Dict[str, str] = {}
+        self._stats: Dict[str, List] = {}
+        self._plans: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def shape(self, sql: str) -> str:
+        shape = self._shapes.get(sql)
+        if shape is None:
+            shape = self._LITERALS.sub('?', sql)
+            shape = self._LISTS.sub('(?)', shape)
+            shape = self._SPACES.sub(' ', shape).strip()
+            if len(self._shapes) >= self.max_shapes:
+                self._shapes.clear()
+            self._shapes[sql] = shape
+        return shape
+
+    def record(self, cursor: sqlite3.Cursor, sql: str, params, elapsed: float) -> None:
+        shape = self.shape(sql)
+        with self._lock:
+            stat = self._stats.get(shape)
+            if stat is None:
+                if len(self._stats) >= self.max_shapes:
+                    return
+                # count, total, max, последние замеры для p99
+                stat = self._stats[shape] = [0, 0.0, 0.0, deque(maxlen=self.samples)]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+            stat[3].append(elapsed)
+        if elapsed * 1000 >= self.slow_ms:
+            self._log_slow(cursor, sql, shape, params, elapsed)
+
+    def _log_slow(self, cursor: sqlite3.Cursor, sql: str, shape: str, params, elapsed: float) -> None:
+        plan = ''
+        now = time.monotonic()
+        verb = shape.split(' ', 1)[0].upper()
+        if params is not None and verb in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH') \
+                and self._plans.get(shape, 0) < now:
+            self._plans[shape] = now + self.plan_ttl
+            try:
+                # Обычный курсор: сам EXPLAIN не должен попасть в статистику
+                rows = cursor.connection.cursor(sqlite3.Cursor).execute(
+                    f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+                plan = '; '.join(row[3] for row in rows)
+            except sqlite3.Error as e:
+                plan = f'n/a ({e})'
+        logger.warning("Slow query %.1fms: %s%s", elapsed * 1000, shape, f" | plan: {plan}" if plan else '')
+
+    def top(self, limit: int = 10, order: str = 'total') -> List[Dict]:
+        with self._lock:
+            items = [(shape, stat[0], stat[1], stat[2], sorted(stat[3])) for shape, stat in self._stats.items()]
+        result = []
+        for shape, count, total, worst, samples in items:
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else 0.0
+            result.append({'shape': shape, 'count': count, 'total_ms': total * 1000,
+                           'avg_ms': total * 1000 / count, 'p99_ms': p99 * 1000, 'max_ms': worst * 1000})
+        key = {'total': 'total_ms', 'count': 'count', 'p99': 'p99_ms', 'avg': 'avg_ms'}.get(order, 'total_ms')
+        return sorted(result, key=lambda r: r[key], reverse=True)[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._plans.clear()
+
+query_profiler = QueryProfiler(QUERY_PROFILER_ENABLED, SLOW_QUERY_MS)
+
+# ============== EVENT LOOP WATCHDOG ==============
+class LoopWatchdog:
+    """Следит за задержкой event loop'ов (uvicorn и бота).
+
+    В каждом цикле крутится heartbeat: sleep(interval) и замер опоздания.
+    Отдельный поток проверяет, давно ли был heartbeat; если цикл завис
+    дольше interval + stall_seconds, он снимает стек потока цикла прямо во
+    время блокировки — в нём видна синхронная функция, которая держит цикл.
+    """
+
+    def __init__(self, interval: float = 0.5, stall_seconds: float = 0.25, stack_depth: int = 20):
+        self.interval = interval
+        self.stall_seconds = stall_seconds
+        self.stack_depth = stack_depth
+        self._loops: Dict[str, Dict] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, name: str) -> asyncio.Task:
+        """Вызывать изнутри отслеживаемого цикла."""
+        loop = asyncio.get_running_loop()
+        state = {'loop': loop, 'thread_id': threading.get_ident(), 'beat': time.monotonic(), 'stalled': False}
+        self._loops[name] = state
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._thread.start()
+        return loop.create_task(self._heartbeat(name, state))
+
+    async def _heartbeat(self, name: str, state: Dict) -> None:
+        labels = (('loop', name),)
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(0.0, now - start - self.interval)
+                metrics.observe('metro_loop_lag_seconds', labels, lag)
+                state['beat'] = now
+                if state['stalled']:
+                    state['stalled'] = False
+                    logger.warning("Event loop '%s' resumed, lag %.2fs", name, lag)
+        finally:
+            self._loops.pop(name, None)
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(self.interval / 2)
+            now = time.monotonic()
+            for name, state in list(self._loops.items()):
+                blocked = now - state['beat'] - self.interval
+                if not state['stalled'] and blocked > self.stall_seconds:
+                    state['stalled'] = True
+                    self._report(name, state, blocked)
+
+    def _report(self, name: str, state: Dict, blocked: float) -> None:
+        metrics.inc('metro_loop_stalls_total', (('loop', name),))
+        frame = sys._current_frames().get(state['thread_id'])
+        stack = ''.join(traceback.format_stack(frame)[-self.stack_depth:]) if frame else '  n/a\n'
+        task = asyncio.current_task(state['loop'])
+        where = f"task {task.get_name()} ({task.get_coro().__qualname__})" if task else 'callback'
+        logger.warning("Event loop '%s' blocked for %.2fs+ in %s:\n%s", name, blocked, where, stack.rstrip())
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_STALL_SECONDS)
+
 # ============== DATABASE ==============
+# products.rating/reviews_count заново из видимых отзывов; WHERE оставляет только расходящиеся строки
+RATINGS_REBUILD_SQL = '''UPDATE products SET reviews_count=agg.cnt, rating=agg.avg
+    FROM (
+        SELECT p.id,
+               (SELECT COUNT(*) FROM reviews r WHERE r.product_id=p.id AND r.is_visible=1) AS cnt,
+               (SELECT COALESCE(AVG(r.rating), 0) FROM reviews r WHERE r.product_id=p.id AND r.is_visible=1) AS avg
+        FROM products p
+    ) AS agg
+    WHERE agg.id=products.id
+      AND (COALESCE(products.reviews_count, 0) != agg.cnt OR ABS(COALESCE(products.rating, 0) - agg.avg) > 1e-9)
+'''
+
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
         self.init_db()
     
     def get_connection(self):
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=TimedConnection)
         conn.row_factory = sqlite3.Row
         return conn
     
@@ -117,10 +659,28 @@ class Database:
         conn.close()
         return [dict(row) for row in rows]
     
+    @contextmanager
+    def transaction(self):
+        conn = self.get_connection()
+        conn.isolation_level = None
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            yield cur
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
     def init_db(self):
         conn = self.get_connection()
         cur = conn.cursor()
         
+        # Действует только для новой базы; существующей нужен разовый VACUUM
+        cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        
         cur.execute('''
         CREATE TABLE IF NOT EXISTS categories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -309,6 +869,99 @@ class Database:
             created_at TEXT
         )''')
         
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS job_state (
+            name TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TEXT
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS referral_rewards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER UNIQUE,
+            referrer_id INTEGER,
+            referral_id INTEGER,
+            amount REAL,
+            batch TEXT,
+            created_at TEXT
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS worker_balances (
+            worker_id INTEGER PRIMARY KEY,
+            worker_username TEXT,
+            pending REAL DEFAULT 0,
+            paid REAL DEFAULT 0,
+            orders_count INTEGER DEFAULT 0,
+            updated_at TEXT
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            orders_count INTEGER DEFAULT 0,
+            revenue REAL DEFAULT 0,
+            new_users INTEGER DEFAULT 0
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_order_status (
+            status TEXT PRIMARY KEY,
+            orders_count INTEGER DEFAULT 0,
+            amount REAL DEFAULT 0
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_products (
+            product_id INTEGER PRIMARY KEY,
+            name TEXT,
+            quantity INTEGER DEFAULT 0,
+            revenue REAL DEFAULT 0
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_hourly (
+            period TEXT,
+            event_type TEXT,
+            events INTEGER DEFAULT 0,
+            PRIMARY KEY (period, event_type)
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_daily (
+            period TEXT,
+            event_type TEXT,
+            events INTEGER DEFAULT 0,
+            PRIMARY KEY (period, event_type)
+        )''')
+        
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS notification_counters (
+            user_id INTEGER PRIMARY KEY,
+            unread INTEGER DEFAULT 0
+        )''')
+        
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_promocode_uses_promo_user ON promocode_uses(promo_id, user_id)')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_order_workers_order_worker ON order_workers(order_id, worker_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_order_workers_worker_status ON order_workers(worker_id, status)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_order_workers_status ON order_workers(status)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_worker_payouts_status_worker ON worker_payouts(status, worker_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_stats_products_revenue ON stats_products(revenue)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_analytics_created ON analytics(created_at)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product ON reviews(product_id, is_visible, id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_referral_rewards_batch ON referral_rewards(batch, referrer_id)')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_orders_completed ON orders(completed_at, id)
+                       WHERE status='completed' ''')
+        
+        # Разовая сверка: до инкрементального учёта рейтинга колонки products не велись
+        cur.execute("SELECT 1 FROM job_state WHERE name='ratings_reconciled'")
+        if not cur.fetchone():
+            cur.execute(RATINGS_REBUILD_SQL)
+            cur.execute("INSERT INTO job_state (name, value, updated_at) VALUES ('ratings_reconciled', 'true', ?)",
+                        (now_iso(),))
+        
         cur.execute('SELECT COUNT(*) FROM categories')
         if cur.fetchone()[0] == 0:
             cur.execute('''
@@ -325,6 +978,1616 @@ class Database:
 
 db = Database(DB_PATH)
 
+# ============== PROMO CODES ==============
+class PromoError(Exception):
+    pass
+
+class PromoEngine:
+    """Индекс активных промокодов в памяти + атомарный учёт использований."""
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._index: Optional[Dict[str, Dict]] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._index = None
+
+    def _active(self) -> Dict[str, Dict]:
+        index = self._index
+        if index is not None:
+            return index
+        with self._lock:
+            generation = self._generation
+        rows = self.db.fetchall('SELECT * FROM promocodes WHERE is_active=1')
+        index = {row['code'].strip().upper(): row for row in rows if row['code']}
+        with self._lock:
+            if generation == self._generation:
+                self._index = index
+        return index
+
+    def get(self, code: str) -> Optional[Dict]:
+        return self._active().get((code or '').strip().upper())
+
+    def _refresh(self, promo: Dict) -> None:
+        # Кэшированные строки не меняем на месте: подменяем запись свежей копией
+        with self._lock:
+            if self._index is not None:
+                self._index[promo['code'].strip().upper()] = promo
+
+    def quote(self, code: str, subtotal: float, at: Optional[str] = None) -> Dict:
+        return self._quote(self.get(code), subtotal, at)
+
+    def _quote(self, promo: Optional[Dict], subtotal: float, at: Optional[str] = None) -> Dict:
+        if not promo:
+            raise PromoError('Промокод не найден')
+        now = at or now_iso()
+        if promo['valid_from'] and now < promo['valid_from']:
+            raise PromoError('Промокод ещё не действует')
+        if promo['valid_until'] and now > promo['valid_until']:
+            raise PromoError('Срок действия промокода истёк')
+        uses_total = promo['uses_total']
+        if uses_total is not None and uses_total >= 0 and promo['uses_count'] >= uses_total:
+            raise PromoError('Промокод закончился')
+        min_order = promo['min_order'] or 0
+        if subtotal < min_order:
+            raise PromoError(f'Минимальная сумма заказа для промокода: {min_order}₽')
+
+        value = promo['value'] or 0
+        if promo['type'] == 'percent':
+            discount = subtotal * value / 100
+        else:
+            discount = value
+        if promo['max_discount'] is not None and promo['max_discount'] > 0:
+            discount = min(discount, promo['max_discount'])
+        discount = round(min(discount, subtotal), 2)
+
+        return {
+            'promo_id': promo['id'],
+            'code': promo['code'],
+            'discount': discount,
+            'total': round(subtotal - discount, 2),
+        }
+
+    def redeem(self, code: str, user_id: int, subtotal: float, order_id: Optional[int] = None) -> Dict:
+        promo = self.get(code)
+        quote = self._quote(promo, subtotal)
+        with self.db.transaction() as cur:
+            # Условный инкремент: счётчик не может превысить uses_total даже при гонке
+            cur.execute('''
+                UPDATE promocodes SET uses_count = uses_count + 1
+                WHERE id=? AND is_active=1
+                  AND (uses_total IS NULL OR uses_total < 0 OR uses_count < uses_total)
+            ''', (promo['id'],))
+            if cur.rowcount == 0:
+                self.invalidate()
+                raise PromoError('Промокод закончился')
+
+            per_user = promo['uses_per_user']
+            if per_user is not None and per_user >= 0:
+                cur.execute('SELECT COUNT(*) FROM promocode_uses WHERE promo_id=? AND user_id=?',
+                            (promo['id'], user_id))
+                if cur.fetchone()[0] >= per_user:
+                    raise PromoError('Вы уже использовали этот промокод')
+
+            cur.execute('''
+                INSERT INTO promocode_uses (promo_id, user_id, order_id, discount_amount, used_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (promo['id'], user_id, order_id, quote['discount'], now_iso()))
+            cur.execute('SELECT * FROM promocodes WHERE id=?', (promo['id'],))
+            fresh = dict(cur.fetchone())
+
+        self._refresh(fresh)
+        return quote
+
+    def create(self, code: str, value: float, type: str = 'percent', min_order: float = 0,
+               max_discount: Optional[float] = None, uses_total: int = -1, uses_per_user: int = 1,
+               valid_from: Optional[str] = None, valid_until: Optional[str] = None) -> int:
+        promo_id = self.db.execute('''
+            INSERT INTO promocodes (code, type, value, min_order, max_discount, uses_total,
+                                    uses_per_user, valid_from, valid_until, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (code.strip().upper(), type, value, min_order, max_discount, uses_total,
+              uses_per_user, valid_from, valid_until, now_iso()))
+        self.invalidate()
+        return promo_id
+
+    def set_active(self, code: str, active: bool) -> None:
+        self.db.execute('UPDATE promocodes SET is_active=? WHERE UPPER(code)=?',
+                        (1 if active else 0, code.strip().upper()))
+        self.invalidate()
+
+promo_engine = PromoEngine(db)
+
+# ============== BACKGROUND JOBS ==============
+def load_state(cur, name: str, default: Any = None) -> Any:
+    cur.execute('SELECT value FROM job_state WHERE name=?', (name,))
+    row = cur.fetchone()
+    return json.loads(row[0]) if row else default
+
+def save_state(cur, name: str, value: Any) -> None:
+    cur.execute('''
+        INSERT INTO job_state (name, value, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+    ''', (name, json.dumps(value), now_iso()))
+
+def accrue_referral_rewards(database: Database = None, batch_size: int = REFERRAL_BATCH_SIZE) -> Dict:
+    """Начисляет рефереру REFERRAL_PERCENT с завершённых заказов, за которые ещё нет начисления.
+
+    Кандидаты выбираются анти-джойном по referral_rewards, а не водяной
+    меткой по completed_at: время ставится до взятия блокировки, и заказ,
+    закоммиченный позже более нового, оказался бы ниже метки. order_id в
+    referral_rewards уникален, поэтому повторный запуск ничего не начислит дважды.
+    """
+    database = database or db
+    stats = {'orders': 0, 'rewards': 0, 'amount': 0.0}
+    while True:
+        with database.transaction() as cur:
+            # Только заказы, которым положено начисление — иначе они выбирались бы каждый раз
+            cur.execute('''
+                SELECT o.id, o.total, o.user_id, u.invited_by
+                FROM orders o
+                JOIN users u ON u.id = o.user_id
+                WHERE o.status='completed' AND u.invited_by IS NOT NULL AND o.total > 0
+                  AND NOT EXISTS (SELECT 1 FROM referral_rewards r WHERE r.order_id = o.id)
+                ORDER BY o.id
+                LIMIT ?
+            ''', (batch_size,))
+            orders = cur.fetchall()
+            if not orders:
+                break
+
+            batch = f"ref:{orders[0]['id']}:{orders[-1]['id']}:{now_iso()}"
+            created_at = now_iso()
+            rewards = [
+                (o['id'], o['invited_by'], o['user_id'], round(o['total'] * REFERRAL_PERCENT, 2), batch, created_at)
+                for o in orders
+            ]
+            cur.executemany('''
+                INSERT OR IGNORE INTO referral_rewards (order_id, referrer_id, referral_id, amount, batch, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rewards)
+            cur.execute('''
+                UPDATE users SET balance = balance + (
+                    SELECT SUM(amount) FROM referral_rewards WHERE batch=? AND referrer_id=users.id
+                )
+                WHERE id IN (SELECT referrer_id FROM referral_rewards WHERE batch=?)
+            ''', (batch, batch))
+            cur.execute('SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM referral_rewards WHERE batch=?', (batch,))
+            count, amount = cur.fetchone()
+
+        stats['orders'] += len(orders)
+        stats['rewards'] += count
+        stats['amount'] = round(stats['amount'] + amount, 2)
+        if len(orders) < batch_size:
+            break
+
+    if stats['orders']:
+        logger.info("Referral accrual: %s", stats)
+    return stats
+
+# ============== CATALOG ==============
+# Версия каталога растёт при любом изменении товаров/категорий; по ней сбрасываются кэши
+_catalog_version = 0
+
+def catalog_version() -> int:
+    return _catalog_version
+
+def bump_catalog_version() -> int:
+    global _catalog_version
+    _catalog_version += 1
+    return _catalog_version
+
+def parse_product(product: Dict) -> Dict:
+    product['photos'] = json.loads(product.get('photos') or '[]')
+    product['tags'] = json.loads(product.get('tags') or '[]')
+    product['meta'] = json.loads(product.get('meta') or '{}')
+    return product
+
+# Ключи сортировки всегда по возрастанию; для DESC-режимов список читается с конца
+CATALOG_SORTS = {
+    'popular': (lambda p: (p['sold_count'] or 0, p['is_featured'] or 0, -p['id']), True),
+    'price_asc': (lambda p: (p['price'] or 0, p['id']), False),
+    'price_desc': (lambda p: (p['price'] or 0, -p['id']), True),
+    'new': (lambda p: (p['created_at'] or '', p['id']), True),
+    'rating': (lambda p: (p['rating'] or 0, -p['id']), True),
+}
+
+class CatalogIndex:
+    """Предсортированные массивы id активных товаров для каждой пары (категория, сортировка).
+
+    Категория None — «все товары». Изменение товара переставляет его id
+    бинарным поиском, листинг — это срез массива.
+
+    views_count в индексе не хранится: просмотры пишутся в обход
+    product_changed и были бы устаревшими; точное число отдаёт карточка товара.
+    Наружу отдаются копии строк, чтобы вызывающий не мог испортить индекс.
+    """
+
+    @staticmethod
+    def _cached(row: Dict) -> Dict:
+        product = parse_product(dict(row))
+        product.pop('views_count', None)
+        return product
+
+    @staticmethod
+    def _copy(product: Dict) -> Dict:
+        return dict(product, photos=list(product['photos']), tags=list(product['tags']), meta=dict(product['meta']))
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._products: Optional[Dict[int, Dict]] = None
+        self._lists: Dict[Tuple[Optional[int], str], array] = {}
+        self._touched: Optional[set] = None
+        self._lock = threading.RLock()
+
+    def reload(self) -> None:
+        with self._lock:
+            self._touched = set()
+        rows = self.db.fetchall('SELECT * FROM products WHERE is_active=1')
+        products = {row['id']: self._cached(row) for row in rows}
+        by_category: Dict[Optional[int], List[int]] = {None: list(products)}
+        for product in products.values():
+            by_category.setdefault(product['category_id'], []).append(product['id'])
+        lists = {}
+        for category_id, ids in by_category.items():
+            for sort, (key, _) in CATALOG_SORTS.items():
+                lists[(category_id, sort)] = array('q', sorted(ids, key=lambda i: key(products[i])))
+        with self._lock:
+            self._products, self._lists = products, lists
+            # Изменения, пришедшие во время полной загрузки, применяем поверх
+            touched, self._touched = self._touched, None
+            for product_id in touched:
+                row = self.db.fetchone('SELECT * FROM products WHERE id=?', (product_id,))
+                if row:
+                    self.upsert(row)
+                else:
+                    self.remove(product_id)
+
+    def _ensure(self) -> Dict[int, Dict]:
+        if self._products is None:
+            with self._lock:
+                if self._products is None:
+                    self.reload()
+        return self._products
+
+    def get(self, product_id: int) -> Optional[Dict]:
+        product = self._ensure().get(product_id)
+        return self._copy(product) if product else None
+
+    def list(self, category_id: Optional[int] = None, sort: str = 'popular',
+             limit: int = 20, offset: int = 0) -> List[Dict]:
+        self._ensure()
+        limit, offset = max(0, limit), max(0, offset)
+        with self._lock:
+            # Словарь и списки берём из одного снимка: reload() подменяет их вместе
+            products = self._products
+            ids = self._lists.get((category_id, sort))
+            if ids is None:
+                return []
+            if CATALOG_SORTS[sort][1]:
+                end = len(ids) - offset
+                page = ids[max(0, end - limit):end][::-1] if end > 0 else []
+            else:
+                page = ids[offset:offset + limit]
+            return [self._copy(products[i]) for i in page]
+
+    def _position(self, ids: array, product: Dict, key) -> int:
+        target = key(product)
+        lo, hi = 0, len(ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(self._products[ids[mid]]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _remove(self, product: Dict) -> None:
+        for category_id in (None, product['category_id']):
+            for sort, (key, _) in CATALOG_SORTS.items():
+                ids = self._lists.get((category_id, sort))
+                if ids is None:
+                    continue
+                pos = self._position(ids, product, key)
+                if pos < len(ids) and ids[pos] == product['id']:
+                    del ids[pos]
+
+    def _insert(self, product: Dict) -> None:
+        for category_id in (None, product['category_id']):
+            for sort, (key, _) in CATALOG_SORTS.items():
+                ids = self._lists.setdefault((category_id, sort), array('q'))
+                ids.insert(self._position(ids, product, key), product['id'])
+
+    def upsert(self, row: Dict) -> None:
+        """Применяет новую версию строки products (неактивный товар удаляется из индекса)."""
+        self._ensure()
+        product = self._cached(row)
+        with self._lock:
+            if self._touched is not None:
+                self._touched.add(product['id'])
+            old = self._products.get(product['id'])
+            if old:
+                self._remove(old)
+                del self._products[old['id']]
+            if product['is_active']:
+                self._products[product['id']] = product
+                self._insert(product)
+
+    def remove(self, product_id: int) -> None:
+        self._ensure()
+        with self._lock:
+            if self._touched is not None:
+                self._touched.add(product_id)
+            old = self._products.get(product_id)
+            if old:
+                self._remove(old)
+                del self._products[product_id]
+
+    def size(self) -> int:
+        return len(self._products or {})
+
+catalog_index = CatalogIndex(db)
+
+def product_changed(product_id: int, database: Database = None) -> None:
+    """Точка синхронизации после записи в products: индекс каталога + версия для кэшей."""
+    database = database or db
+    if database is catalog_index.db:
+        row = database.fetchone('SELECT * FROM products WHERE id=?', (product_id,))
+        if row:
+            catalog_index.upsert(row)
+        else:
+            catalog_index.remove(product_id)
+    bump_catalog_version()
+
+class RenderCache:
+    """Готовые тексты и разметка бота, действительные пока не сменилась версия каталога.
+
+    TTL подстраховывает от правок в БД в обход product_changed().
+    """
+
+    def __init__(self, max_items: int = 5000, ttl: float = 300):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: 'OrderedDict[Any, Tuple[int, float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, build):
+        version, now = catalog_version(), time.monotonic()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry and entry[0] == version and entry[1] > now:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        value = build()
+        with self._lock:
+            self._items[key] = (version, now + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return value
+
+render_cache = RenderCache(ttl=RENDER_CACHE_TTL)
+
+# ============== CATALOG IMPORT ==============
+class CatalogImportError(Exception):
+    pass
+
+_TRUE_VALUES = {'1', 'true', 'yes', 'да', '+'}
+
+def _import_value(raw: Dict, key: str):
+    value = raw.get(key)
+    if isinstance(value, str):
+        value = value.strip()
+    return None if value in (None, '') else value
+
+def _import_list(value, separator: str) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [item.strip() for item in value.split(separator) if item.strip()]
+    if not isinstance(value, list):
+        raise ValueError('ожидается список')
+    return json.dumps(value, ensure_ascii=False)
+
+def parse_import_row(raw: Dict) -> Dict:
+    """Проверяет строку импорта; ValueError с понятным текстом, если строка негодная."""
+    name = _import_value(raw, 'name')
+    if not name:
+        raise ValueError('нет name')
+    try:
+        price = float(_import_value(raw, 'price'))
+    except (TypeError, ValueError):
+        raise ValueError('price должен быть числом')
+    # float() принимает nan/inf: nan ушёл бы в SQLite как NULL и уронил всю пачку
+    if not math.isfinite(price):
+        raise ValueError('price должен быть конечным числом')
+    if price <= 0:
+        raise ValueError('price должен быть > 0')
+
+    def number(key: str, cast):
+        value = _import_value(raw, key)
+        if value is None:
+            return None
+        try:
+            value = cast(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{key} должен быть числом')
+        if cast is float and not math.isfinite(value):
+            raise ValueError(f'{key} должен быть конечным числом')
+        return value
+
+    def flag(key: str) -> Optional[int]:
+        value = _import_value(raw, key)
+        return None if value is None else int(str(value).lower() in _TRUE_VALUES)
+
+    category_id = number('category_id', int)
+    category = _import_value(raw, 'category')
+    if category_id is None and not category:
+        raise ValueError('нет category или category_id')
+
+    return {
+        'id': number('id', int),
+        'category_id': category_id,
+        'category': str(category) if category else None,
+        'name': str(name),
+        'price': price,
+        'old_price': number('old_price', float),
+        'short_description': _import_value(raw, 'short_description'),
+        'description': _import_value(raw, 'description'),
+        'photo': _import_value(raw, 'photo'),
+        'photos': _import_list(_import_value(raw, 'photos'), '|'),
+        'stock': number('stock', int),
+        'is_active': flag('is_active'),
+        'is_featured': flag('is_featured'),
+        'sort_order': number('sort_order', int),
+        'tags': _import_list(_import_value(raw, 'tags'), ','),
+    }
+
+def iter_import_rows(stream, fmt: str) -> Iterator[Tuple[int, Dict]]:
+    """Построчно читает CSV (разделитель , ; или TAB) или JSONL, не загружая файл целиком."""
+    if fmt == 'jsonl':
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                raw = json.loads(line)
+            except ValueError:
+                raw = None
+            yield line_no, raw if isinstance(raw, dict) else {'__error__': 'не JSON-объект'}
+        return
+    if fmt != 'csv':
+        raise CatalogImportError(f'Неизвестный формат: {fmt}')
+    header = stream.readline()
+    if not header.strip():
+        return
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(itertools.chain([header], stream), dialect=dialect)
+    reader.fieldnames = [field.strip().lower() for field in reader.fieldnames]
+    for raw in reader:
+        yield reader.line_num, raw
+
+_IMPORT_UPDATE_SQL = '''
+    UPDATE products SET category_id=?, name=?, price=?, old_price=COALESCE(?, old_price),
+        short_description=COALESCE(?, short_description), description=COALESCE(?, description),
+        photo=COALESCE(?, photo), photos=COALESCE(?, photos), stock=COALESCE(?, stock),
+        is_active=COALESCE(?, is_active), is_featured=COALESCE(?, is_featured),
+        sort_order=COALESCE(?, sort_order), tags=COALESCE(?, tags), updated_at=?
+    WHERE id=?
+'''
+_IMPORT_INSERT_SQL = '''
+    INSERT INTO products (category_id, name, price, old_price, short_description, description, photo, photos,
+                          stock, is_active, is_featured, sort_order, tags, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, '[]'), COALESCE(?, -1), COALESCE(?, 1), COALESCE(?, 0),
+            COALESCE(?, 0), COALESCE(?, '[]'), ?, ?)
+'''
+
+def import_catalog(stream, fmt: str, progress=None, batch_size: int = CATALOG_IMPORT_BATCH,
+                   database: Database = None) -> Dict:
+    """Потоковый импорт товаров пачками по batch_size, каждая пачка — одна транзакция.
+
+    Товар ищется по id, иначе по (категория, название без учёта регистра);
+    найденный обновляется (пустые поля не затирают старые значения), новый
+    вставляется. Категории сопоставляются по названию, недостающие создаются.
+    Индекс каталога и кэши пересобираются один раз в конце.
+    """
+    database = database or db
+    categories = {row['name'].strip().lower(): row['id']
+                  for row in database.fetchall('SELECT id, name FROM categories')}
+    category_ids = set(categories.values())
+    existing = {(row['category_id'], row['name'].strip().lower()): row['id']
+                for row in database.fetchall('SELECT id, category_id, name FROM products')}
+    product_ids = set(existing.values())
+    stats = {'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'categories_created': 0, 'errors': []}
+
+    def skip(line_no: int, reason: str) -> None:
+        stats['skipped'] += 1
+        if len(stats['errors']) < 20:
+            stats['errors'].append(f'строка {line_no}: {reason}')
+
+    def flush(batch: List[Tuple[int, Dict]]) -> None:
+        now = now_iso()
+        updates, inserts, insert_keys = [], [], {}
+        with database.transaction() as cur:
+            for line_no, row in batch:
+                category_id = row['category_id']
+                if category_id is None:
+                    key = row['category'].strip().lower()
+                    category_id = categories.get(key)
+                    if category_id is None:
+                        cur.execute('INSERT INTO categories (name, created_at) VALUES (?, ?)', (row['category'], now))
+                        category_id = categories[key] = cur.lastrowid
+                        category_ids.add(category_id)
+                        stats['categories_created'] += 1
+                elif category_id not in category_ids:
+                    skip(line_no, f'нет категории id={category_id}')
+                    continue
+
+                params = (category_id, row['name'], row['price'], row['old_price'], row['short_description'],
+                          row['description'], row['photo'], row['photos'], row['stock'], row['is_active'],
+                          row['is_featured'], row['sort_order'], row['tags'], now)
+                key = (category_id, row['name'].lower())
+                product_id = row['id'] if row['id'] in product_ids else existing.get(key)
+                if product_id:
+                    updates.append(params + (product_id,))
+                    existing[key] = product_id
+                elif key in insert_keys:
+                    inserts[insert_keys[key]] = params + (now,)  # повтор в пачке: побеждает последняя строка
+                else:
+                    insert_keys[key] = len(inserts)
+                    inserts.append(params + (now,))
+
+            cur.executemany(_IMPORT_UPDATE_SQL, updates)
+            cur.executemany(_IMPORT_INSERT_SQL, inserts)
+            if inserts:
+                # AUTOINCREMENT под BEGIN IMMEDIATE выдаёт id пачки подряд
+                last_id = cur.execute('SELECT last_insert_rowid()').fetchone()[0]
+                for offset, key in enumerate(insert_keys):
+                    existing[key] = last_id - len(inserts) + 1 + offset
+                    product_ids.add(existing[key])
+        stats['updated'] += len(updates)
+        stats['inserted'] += len(inserts)
+
+    batch = []
+    try:
+        for line_no, raw in iter_import_rows(stream, fmt):
+            stats['rows'] += 1
+            if '__error__' in raw:
+                skip(line_no, raw['__error__'])
+                continue
+            try:
+                batch.append((line_no, parse_import_row(raw)))
+            except ValueError as e:
+                skip(line_no, str(e))
+                continue
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+                if progress:
+                    progress(stats)
+        if batch:
+            flush(batch)
+    finally:
+        # Даже при обрыве файла уже записанные пачки должны попасть в индекс и кэши
+        if stats['inserted'] or stats['updated']:
+            if database is catalog_index.db:
+                catalog_index.reload()
+            bump_catalog_version()
+    if progress:
+        progress(stats)
+    return stats
+
+# ============== REVIEWS ==============
+# reviews.user_id — это users.id (как в cart/favorites/orders)
+def fetch_reviews(product_id: int, limit: int = 5, before_id: Optional[int] = None,
+                  database: Database = None) -> List[Dict]:
+    database = database or db
+    query = '''
+        SELECT r.*, u.first_name, u.username
+        FROM reviews r
+        LEFT JOIN users u ON r.user_id = u.id
+        WHERE r.product_id=? AND r.is_visible=1
+    '''
+    params = [product_id]
+    if before_id:
+        query += ' AND r.id < ?'
+        params.append(before_id)
+    query += ' ORDER BY r.id DESC LIMIT ?'
+    params.append(limit)
+    reviews = database.fetchall(query, tuple(params))
+    for r in reviews:
+        r['photos'] = json.loads(r.get('photos') or '[]')
+    return reviews
+
+def _apply_rating_delta(cur, product_id: int, count_delta: int, rating_delta: float) -> None:
+    # Среднее пересчитывается из старых значений строки без полного пересчёта по reviews
+    cur.execute('''
+        UPDATE products SET
+            rating = CASE WHEN reviews_count + ? > 0
+                          THEN (rating * reviews_count + ?) / (reviews_count + ?)
+                          ELSE 0 END,
+            reviews_count = MAX(reviews_count + ?, 0)
+        WHERE id=?
+    ''', (count_delta, rating_delta, count_delta, count_delta, product_id))
+
+def add_review(product_id: int, user_id: int, rating: int, text: Optional[str] = None,
+               order_id: Optional[int] = None, worker_id: Optional[int] = None,
+               is_verified: bool = False, database: Database = None) -> int:
+    database = database or db
+    rating = max(1, min(5, int(rating)))
+    with database.transaction() as cur:
+        cur.execute('''
+            INSERT INTO reviews (order_id, product_id, user_id, worker_id, rating, text, is_verified, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (order_id, product_id, user_id, worker_id, rating, text, 1 if is_verified else 0, now_iso()))
+        review_id = cur.lastrowid
+        _apply_rating_delta(cur, product_id, 1, rating)
+    product_changed(product_id, database)
+    return review_id
+
+def set_review_visible(review_id: int, visible: bool, database: Database = None) -> bool:
+    database = database or db
+    with database.transaction() as cur:
+        cur.execute('SELECT product_id, rating, is_visible FROM reviews WHERE id=?', (review_id,))
+        review = cur.fetchone()
+        if not review or bool(review['is_visible']) == visible:
+            return False
+        cur.execute('UPDATE reviews SET is_visible=? WHERE id=?', (1 if visible else 0, review_id))
+        sign = 1 if visible else -1
+        _apply_rating_delta(cur, review['product_id'], sign, sign * review['rating'])
+    product_changed(review['product_id'], database)
+    return True
+
+def delete_review(review_id: int, database: Database = None) -> bool:
+    database = database or db
+    with database.transaction() as cur:
+        cur.execute('SELECT product_id, rating, is_visible FROM reviews WHERE id=?', (review_id,))
+        review = cur.fetchone()
+        if not review:
+            return False
+        cur.execute('DELETE FROM reviews WHERE id=?', (review_id,))
+        if review['is_visible']:
+            _apply_rating_delta(cur, review['product_id'], -1, -review['rating'])
+    product_changed(review['product_id'], database)
+    return True
+
+def rebuild_ratings(database: Database = None) -> int:
+    """Пересчитывает рейтинги всех товаров по отзывам; возвращает число исправленных товаров."""
+    database = database or db
+    with database.transaction() as cur:
+        cur.execute(RATINGS_REBUILD_SQL)
+        fixed = cur.rowcount
+    if fixed:
+        if database is catalog_index.db:
+            catalog_index.reload()
+        bump_catalog_version()
+    logger.info("Ratings rebuilt, fixed %s products", fixed)
+    return fixed
+
+# ============== CART ==============
+def apply_cart_edits(user_id: int, deltas: Dict[int, int], removed: set, database: Database = None) -> None:
+    """Применяет накопленные ➕/➖/🗑 одной транзакцией; позиции с quantity <= 0 удаляются."""
+    database = database or db
+    with database.transaction() as cur:
+        cur.executemany('UPDATE cart SET quantity = quantity + ? WHERE user_id=? AND product_id=?',
+                        [(delta, user_id, product_id) for product_id, delta in deltas.items() if delta])
+        cur.executemany('DELETE FROM cart WHERE user_id=? AND product_id=?',
+                        [(user_id, product_id) for product_id in removed])
+        cur.execute('DELETE FROM cart WHERE user_id=? AND quantity <= 0', (user_id,))
+
+# ============== RATE LIMITING ==============
+class TokenBucketLimiter:
+    """Token bucket на ключ: rate токенов в секунду, не больше burst в запасе.
+
+    Экземпляр рассчитан на один event loop (API или бот), поэтому без блокировок.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 50000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[str, List[float]]' = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.allowed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self, key: str) -> int:
+        bucket = self._buckets.get(key)
+        if not bucket or bucket[0] >= 1:
+            return 0
+        return max(1, int((1 - bucket[0]) / self.rate + 0.999))
+
+api_read_limiter = TokenBucketLimiter(*RATE_LIMIT_READ)
+api_write_limiter = TokenBucketLimiter(*RATE_LIMIT_WRITE)
+bot_callback_limiter = TokenBucketLimiter(*RATE_LIMIT_BOT)
+
+# ============== FAVORITES ==============
+class FavoritesCache:
+    """Множества избранного по пользователям (LRU); toggle пишет в БД и обновляет множество.
+
+    Множества неизменяемые (frozenset) и подменяются целиком под блокировкой,
+    поэтому вызывающий может итерировать результат get() без гонок.
+    """
+
+    def __init__(self, database: Database, max_users: int = 10000):
+        self.db = database
+        self.max_users = max_users
+        self._sets: 'OrderedDict[int, frozenset]' = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> frozenset:
+        with self._lock:
+            ids = self._sets.get(user_id)
+            if ids is not None:
+                self._sets.move_to_end(user_id)
+                metrics.inc('metro_cache_requests_total', (('cache', 'favorites'), ('result', 'hit')))
+                return ids
+            generation = self._generation
+        metrics.inc('metro_cache_requests_total', (('cache', 'favorites'), ('result', 'miss')))
+        rows = self.db.fetchall('SELECT product_id FROM favorites WHERE user_id=?', (user_id,))
+        ids = frozenset(row['product_id'] for row in rows)
+        with self._lock:
+            # Пока читали, toggle мог изменить избранное — такой снимок не кэшируем
+            if generation == self._generation:
+                ids = self._sets.setdefault(user_id, ids)
+                while len(self._sets) > self.max_users:
+                    self._sets.popitem(last=False)
+        return ids
+
+    def contains(self, user_id: int, product_id: int) -> bool:
+        return product_id in self.get(user_id)
+
+    def toggle(self, user_id: int, product_id: int) -> bool:
+        try:
+            with self.db.transaction() as cur:
+                cur.execute('DELETE FROM favorites WHERE user_id=? AND product_id=?', (user_id, product_id))
+                added = cur.rowcount == 0
+                if added:
+                    cur.execute('INSERT INTO favorites (user_id, product_id, added_at) VALUES (?, ?, ?)',
+                                (user_id, product_id, now_iso()))
+                # Обновляем кэш внутри транзакции: BEGIN IMMEDIATE упорядочивает toggle как в БД
+                with self._lock:
+                    self._generation += 1
+                    ids = self._sets.get(user_id)
+                    if ids is not None:
+                        self._sets[user_id] = ids | {product_id} if added else ids - {product_id}
+        except BaseException:
+            self.invalidate(user_id)
+            raise
+        return added
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._sets.clear()
+            else:
+                self._sets.pop(user_id, None)
+
+favorites_cache = FavoritesCache(db)
+
+# ============== LIVE EVENTS ==============
+class EventHub:
+    """Внутрипроцессный pub/sub: бот и WebApp публикуют, SSE-соединения читают.
+
+    Подписчики живут в цикле uvicorn, а публикуют и из цикла бота, поэтому
+    доставка идёт через call_soon_threadsafe в цикл подписчика.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers: Dict[int, set] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id: int) -> Tuple[asyncio.AbstractEventLoop, asyncio.Queue]:
+        subscription = (asyncio.get_running_loop(), asyncio.Queue(self.queue_size))
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id: int, subscription) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def connections(self) -> int:
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def publish(self, user_id: int, event: str, data: Optional[Dict] = None) -> None:
+        subscribers = self._subscribers.get(user_id)
+        if not subscribers:
+            return
+        with self._lock:
+            subscribers = list(subscribers)
+        message = (event, json.dumps(data or {}, ensure_ascii=False))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, message)
+            except RuntimeError:
+                pass  # цикл подписчика уже закрыт
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, message: Tuple[str, str]) -> None:
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+    def backlog(self) -> int:
+        with self._lock:
+            return sum(queue.qsize() for subscribers in self._subscribers.values() for _, queue in subscribers)
+
+event_hub = EventHub(SSE_QUEUE_SIZE)
+
+@metrics.collector
+def collect_service_metrics():
+    yield 'metro_cache_requests_total', (('cache', 'render'), ('result', 'hit')), render_cache.hits
+    yield 'metro_cache_requests_total', (('cache', 'render'), ('result', 'miss')), render_cache.misses
+    for scope, limiter in (('api_read', api_read_limiter), ('api_write', api_write_limiter),
+                           ('bot_callback', bot_callback_limiter)):
+        yield 'metro_rate_limit_total', (('scope', scope), ('result', 'allowed')), limiter.allowed
+        yield 'metro_rate_limit_total', (('scope', scope), ('result', 'rejected')), limiter.rejected
+    yield 'metro_sse_connections', (), event_hub.connections()
+    yield 'metro_queue_depth', (('queue', 'sse_events'),), event_hub.backlog()
+    if backup_status:
+        yield 'metro_backup_last_timestamp_seconds', (), backup_status['finished_ts']
+        yield 'metro_backup_duration_seconds', (), backup_status['duration_s']
+        yield 'metro_backup_size_bytes', (), backup_status['bytes']
+
+# ============== NOTIFICATIONS ==============
+def insert_notification(cur, user_id: int, type: str, title: str, message: str, data: Optional[Dict] = None) -> int:
+    cur.execute('''
+        INSERT INTO notifications (user_id, type, title, message, data, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, type, title, message, json.dumps(data or {}, ensure_ascii=False), now_iso()))
+    notification_id = cur.lastrowid
+    cur.execute('''
+        INSERT INTO notification_counters (user_id, unread) VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET unread = unread + 1
+    ''', (user_id,))
+    return notification_id
+
+def notify_user(user_id: int, type: str, title: str, message: str, data: Optional[Dict] = None,
+                database: Database = None) -> int:
+    database = database or db
+    with database.transaction() as cur:
+        unread = _ensure_unread_counter(cur, user_id) + 1
+        notification_id = insert_notification(cur, user_id, type, title, message, data)
+    event_hub.publish(user_id, 'notification', {'id': notification_id, 'type': type, 'title': title, 'unread': unread})
+    return notification_id
+
+def _ensure_unread_counter(cur, user_id: int) -> int:
+    # Счётчик заводится один раз; для старых уведомлений считаем COUNT(*) единожды
+    cur.execute('SELECT unread FROM notification_counters WHERE user_id=?', (user_id,))
+    row = cur.fetchone()
+    if row:
+        return row[0]
+    cur.execute('SELECT COUNT(*) FROM notifications WHERE user_id=? AND is_read=0', (user_id,))
+    unread = cur.fetchone()[0]
+    cur.execute('INSERT INTO notification_counters (user_id, unread) VALUES (?, ?)', (user_id, unread))
+    return unread
+
+def get_unread_count(user_id: int, database: Database = None) -> int:
+    database = database or db
+    row = database.fetchone('SELECT unread FROM notification_counters WHERE user_id=?', (user_id,))
+    if row:
+        return row['unread']
+    with database.transaction() as cur:
+        return _ensure_unread_counter(cur, user_id)
+
+def mark_notifications_read(user_id: int, ids: Optional[List[int]] = None, up_to_id: Optional[int] = None,
+                            database: Database = None) -> int:
+    database = database or db
+    where, params = 'user_id=? AND is_read=0', [user_id]
+    if ids is not None:
+        if not ids:
+            return 0
+        where += f" AND id IN ({','.join('?' * len(ids))})"
+        params.extend(ids)
+    if up_to_id is not None:
+        where += ' AND id <= ?'
+        params.append(up_to_id)
+
+    with database.transaction() as cur:
+        _ensure_unread_counter(cur, user_id)
+        cur.execute(f'UPDATE notifications SET is_read=1 WHERE {where}', params)
+        marked = cur.rowcount
+        if marked:
+            cur.execute('UPDATE notification_counters SET unread = MAX(unread - ?, 0) WHERE user_id=?',
+                        (marked, user_id))
+            cur.execute('SELECT unread FROM notification_counters WHERE user_id=?', (user_id,))
+            unread = cur.fetchone()[0]
+    if marked:
+        event_hub.publish(user_id, 'notification', {'unread': unread})
+    return marked
+
+# ============== ANALYTICS ROLLUPS & RETENTION ==============
+def rollup_analytics(database: Database = None, batch_size: int = ANALYTICS_BATCH_SIZE) -> Dict:
+    """Дописывает события после водяной метки (analytics.id) в почасовые и дневные агрегаты."""
+    database = database or db
+    rolled = 0
+    while True:
+        with database.transaction() as cur:
+            mark_id = load_state(cur, 'analytics_watermark', 0)
+            cur.execute('SELECT MAX(id), COUNT(*) FROM (SELECT id FROM analytics WHERE id > ? ORDER BY id LIMIT ?)',
+                        (mark_id, batch_size))
+            upto, count = cur.fetchone()
+            if not count:
+                break
+            for table, width in (('analytics_hourly', 13), ('analytics_daily', 10)):
+                cur.execute(f'''
+                    INSERT INTO {table} (period, event_type, events)
+                    SELECT substr(created_at, 1, {width}), COALESCE(event_type, ''), COUNT(*)
+                    FROM analytics WHERE id > ? AND id <= ?
+                    GROUP BY 1, 2
+                    ON CONFLICT(period, event_type) DO UPDATE SET events = events + excluded.events
+                ''', (mark_id, upto))
+            save_state(cur, 'analytics_watermark', upto)
+        rolled += count
+        if count < batch_size:
+            break
+    return {'events': rolled}
+
+def _archive_analytics(rows: List[sqlite3.Row]) -> List[Tuple[str, str]]:
+    """Сжимает пачку во временные .part-файлы; возвращает пары (part, архив дня)."""
+    os.makedirs(ANALYTICS_ARCHIVE_DIR, exist_ok=True)
+    by_day: Dict[str, List[str]] = {}
+    for row in rows:
+        by_day.setdefault((row['created_at'] or 'unknown')[:10], []).append(json.dumps(dict(row), ensure_ascii=False))
+    parts = []
+    for day, lines in by_day.items():
+        target = os.path.join(ANALYTICS_ARCHIVE_DIR, f'analytics-{day}.jsonl.gz')
+        part = f'{target}.{rows[0]["id"]}.part'
+        parts.append((part, target))
+        with gzip.open(part, 'wt', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+    return parts
+
+def _commit_archive(parts: List[Tuple[str, str]], committed: bool) -> None:
+    # Склеенные gzip-потоки — валидный gzip, поэтому готовый кусок просто дописываем
+    for part, target in parts:
+        if committed:
+            with open(part, 'rb') as src, open(target, 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+        os.remove(part)
+
+def compact_analytics(database: Database = None, retention_days: int = ANALYTICS_RETENTION_DAYS,
+                      batch_size: int = 500, pause: float = 0.05) -> Dict:
+    """Удаляет (или архивирует) сырые события старше retention_days маленькими транзакциями.
+
+    Удаляются только события, уже попавшие в агрегаты. Между пачками
+    блокировка записи отпускается, чтобы не задерживать основной трафик.
+    """
+    database = database or db
+    rollup_analytics(database)
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+    deleted = 0
+    while True:
+        # Пачку читаем и сжимаем без блокировки записи; транзакция только удаляет
+        conn = database.get_connection()
+        try:
+            cur = conn.cursor()
+            mark_id = load_state(cur, 'analytics_watermark', 0)
+            cur.execute('SELECT * FROM analytics WHERE created_at < ? AND id <= ? ORDER BY id LIMIT ?',
+                        (cutoff, mark_id, batch_size))
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            break
+        parts = _archive_analytics(rows) if ANALYTICS_ARCHIVE_DIR else []
+        committed = False
+        try:
+            with database.transaction() as cur:
+                # Диапазон id фиксирован, created_at не меняется — удаляются ровно прочитанные строки
+                cur.execute('DELETE FROM analytics WHERE id BETWEEN ? AND ? AND created_at < ?',
+                            (rows[0]['id'], rows[-1]['id'], cutoff))
+            committed = True
+        finally:
+            _commit_archive(parts, committed)
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    freed = 0
+    conn = database.get_connection()
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            # executescript шагает оператор до конца; execute освободил бы одну страницу
+            conn.executescript(f'PRAGMA incremental_vacuum({ANALYTICS_VACUUM_PAGES});')
+            freed = before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    finally:
+        conn.close()
+
+    if deleted or freed:
+        logger.info("Analytics compaction: deleted %s events, freed %s pages", deleted, freed)
+    return {'deleted': deleted, 'freed_pages': freed}
+
+def db_size_report(database: Database = None) -> Dict:
+    database = database or db
+    conn = database.get_connection()
+    try:
+        pragma = lambda name: conn.execute(f'PRAGMA {name}').fetchone()[0]
+        page_size = pragma('page_size')
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )]
+        report = {
+            'file_bytes': sum(os.path.getsize(p) for p in (database.db_path, database.db_path + '-wal')
+                              if os.path.exists(p)),
+            'page_size': page_size,
+            'pages': pragma('page_count'),
+            'free_pages': pragma('freelist_count'),
+            'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(pragma('auto_vacuum')),
+            'rows': {t: conn.execute(f'SELECT COUNT(*) FROM "{t}"').fetchone()[0] for t in tables},
+        }
+    finally:
+        conn.close()
+    report['free_bytes'] = report['free_pages'] * page_size
+    return report
+
+# ============== BACKUPS ==============
+class BackupError(Exception):
+    pass
+
+class _BackupRestarted(Exception):
+    pass
+
+_backup_lock = threading.Lock()
+backup_status: Dict[str, Any] = {}
+
+def backup_files(directory: str, stem: str) -> List[str]:
+    names = [n for n in os.listdir(directory) if n.startswith(f'{stem}-') and n.endswith(('.db', '.db.gz'))]
+    return [os.path.join(directory, n) for n in sorted(names)]
+
+def backup_database(database: Database = None, directory: str = None, keep: int = None,
+                    compress: bool = None) -> Dict:
+    """Онлайн-снимок через sqlite3 backup API.
+
+    Копируем по BACKUP_STEP_PAGES страниц и спим между шагами, чтобы писатели
+    успевали брать блокировку. Если запись в источник всё время перезапускает
+    копирование, после BACKUP_MAX_RESTARTS перезапусков снимок делается одним
+    шагом. Каждый снимок проходит integrity_check до сжатия и ротации.
+    """
+    database = database or db
+    directory = directory or BACKUP_DIR
+    keep = BACKUP_KEEP if keep is None else keep
+    compress = BACKUP_COMPRESS if compress is None else compress
+    if not _backup_lock.acquire(blocking=False):
+        raise BackupError('бэкап уже выполняется')
+
+    started = time.monotonic()
+    stem = os.path.splitext(os.path.basename(database.db_path))[0]
+    target = os.path.join(directory, f"{stem}-{datetime.now():%Y%m%d-%H%M%S}.db")
+    partial, packed = target + '.part', target + '.gz.part'
+    temporary = (partial, partial + '-journal', packed)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Недописанные файлы прерванного процесса ротация не видит — убираем их здесь
+        for name in os.listdir(directory):
+            if name.startswith(f'{stem}-') and '.part' in name:
+                os.remove(os.path.join(directory, name))
+        restarts = 0
+        remaining_before = [None]
+
+        def step(status, remaining, total):
+            nonlocal restarts
+            # После записи в источник копирование начинается заново — remaining не убывает
+            if remaining_before[0] is not None and remaining >= remaining_before[0]:
+                restarts += 1
+                if restarts > BACKUP_MAX_RESTARTS:
+                    raise _BackupRestarted()
+            remaining_before[0] = remaining
+            time.sleep(BACKUP_STEP_SLEEP)
+
+        source = database.get_connection()
+        try:
+            for pages in (BACKUP_STEP_PAGES, -1):
+                destination = sqlite3.connect(partial)
+                try:
+                    source.backup(destination, pages=pages, progress=step if pages > 0 else None)
+                    check = destination.execute('PRAGMA integrity_check').fetchone()[0]
+                    break
+                except _BackupRestarted:
+                    logger.warning("Backup restarted %s times by concurrent writes, copying in one step", restarts)
+                finally:
+                    destination.close()
+        finally:
+            source.close()
+        if check != 'ok':
+            raise BackupError(f'integrity_check: {check}')
+
+        if compress:
+            with open(partial, 'rb') as src, gzip.open(packed, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.remove(partial)
+            os.replace(packed, target + '.gz')
+            target += '.gz'
+        else:
+            os.replace(partial, target)
+
+        removed = 0
+        for old in backup_files(directory, stem)[:-keep] if keep > 0 else []:
+            os.remove(old)
+            removed += 1
+
+        result = {
+            'path': target,
+            'bytes': os.path.getsize(target),
+            'finished_at': now_iso(),
+            'duration_s': round(time.monotonic() - started, 3),
+            'restarts': restarts,
+            'removed': removed,
+        }
+        backup_status.update(result, finished_ts=time.time())
+        with database.transaction() as cur:
+            save_state(cur, 'backup_last', result)
+        logger.info("Backup %s: %s bytes in %.2fs", target, result['bytes'], result['duration_s'])
+        return result
+    except BaseException:
+        for path in temporary:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        _backup_lock.release()
+
+def get_backup_status(database: Database = None) -> Optional[Dict]:
+    if backup_status:
+        return dict(backup_status)
+    database = database or db
+    row = database.fetchone("SELECT value FROM job_state WHERE name='backup_last'")
+    return json.loads(row['value']) if row else None
+
+# ============== STATISTICS ==============
+def order_product_rows(order: Dict) -> List[Tuple[int, Optional[str], int, float]]:
+    rows = []
+    for item in json.loads(order['items'] or '[]'):
+        if isinstance(item, dict) and item.get('product_id'):
+            quantity = int(item.get('quantity') or 1)
+            rows.append((item['product_id'], item.get('name'), quantity, (item.get('price') or 0) * quantity))
+    return rows
+
+def _bump_daily(cur, day: str, orders: int = 0, revenue: float = 0, new_users: int = 0) -> None:
+    cur.execute('''
+        INSERT INTO stats_daily (day, orders_count, revenue, new_users) VALUES (?, ?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            orders_count = orders_count + excluded.orders_count,
+            revenue = revenue + excluded.revenue,
+            new_users = new_users + excluded.new_users
+    ''', (day, orders, revenue, new_users))
+
+def apply_order_stats(cur, before: Optional[Dict], after: Dict) -> None:
+    """Инкрементально переносит заказ между агрегатами при смене статуса (before=None — новый заказ)."""
+    if before:
+        cur.execute('''
+            UPDATE stats_order_status SET orders_count = orders_count - 1, amount = amount - ?
+            WHERE status=?
+        ''', (before['total'] or 0, before['status']))
+    cur.execute('''
+        INSERT INTO stats_order_status (status, orders_count, amount) VALUES (?, 1, ?)
+        ON CONFLICT(status) DO UPDATE SET
+            orders_count = orders_count + 1,
+            amount = amount + excluded.amount
+    ''', (after['status'], after['total'] or 0))
+
+    was_completed = bool(before) and before['status'] == 'completed'
+    if was_completed == (after['status'] == 'completed'):
+        return
+    sign, order = (-1, before) if was_completed else (1, after)
+    _bump_daily(cur, (order['completed_at'] or now_iso())[:10], orders=sign, revenue=sign * (order['total'] or 0))
+    for product_id, name, quantity, revenue in order_product_rows(order):
+        cur.execute('''
+            INSERT INTO stats_products (product_id, name, quantity, revenue) VALUES (?, ?, ?, ?)
+            ON CONFLICT(product_id) DO UPDATE SET
+                name = COALESCE(excluded.name, name),
+                quantity = quantity + excluded.quantity,
+                revenue = revenue + excluded.revenue
+        ''', (product_id, name, sign * quantity, sign * revenue))
+
+def record_user_registered(database: Database = None) -> None:
+    database = database or db
+    with database.transaction() as cur:
+        _bump_daily(cur, now_iso()[:10], new_users=1)
+
+def get_stats_snapshot(days: int = 7, top: int = 5, database: Database = None) -> Dict:
+    database = database or db
+    since = (datetime.utcnow() - timedelta(days=days - 1)).date().isoformat()
+    return {
+        'days': database.fetchall('SELECT * FROM stats_daily WHERE day >= ? ORDER BY day DESC', (since,)),
+        'statuses': database.fetchall('SELECT * FROM stats_order_status WHERE orders_count > 0 ORDER BY orders_count DESC'),
+        'top_products': database.fetchall('''
+            SELECT * FROM stats_products WHERE quantity > 0 ORDER BY revenue DESC LIMIT ?
+        ''', (top,)),
+    }
+
+STATS_REBUILD_QUERIES = {
+    'stats_order_status': ('status', '''
+        INSERT INTO stats_order_status (status, orders_count, amount)
+        SELECT status, COUNT(*), COALESCE(SUM(total), 0) FROM orders GROUP BY status
+    '''),
+    'stats_daily': ('day', '''
+        INSERT INTO stats_daily (day, orders_count, revenue, new_users)
+        SELECT substr(completed_at, 1, 10), COUNT(*), COALESCE(SUM(total), 0), 0
+        FROM orders WHERE status='completed' AND completed_at IS NOT NULL
+        GROUP BY 1;
+        INSERT INTO stats_daily (day, orders_count, revenue, new_users)
+        SELECT substr(registered_at, 1, 10), 0, 0, COUNT(*)
+        FROM users WHERE registered_at IS NOT NULL
+        GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET new_users = excluded.new_users
+    '''),
+    'stats_products': ('product_id', '''
+        INSERT INTO stats_products (product_id, name, quantity, revenue)
+        SELECT json_extract(j.value, '$.product_id'),
+               MAX(json_extract(j.value, '$.name')),
+               SUM(COALESCE(json_extract(j.value, '$.quantity'), 1)),
+               SUM(COALESCE(json_extract(j.value, '$.price'), 0) * COALESCE(json_extract(j.value, '$.quantity'), 1))
+        FROM orders o, json_each(o.items) j
+        WHERE o.status='completed' AND json_extract(j.value, '$.product_id') IS NOT NULL
+        GROUP BY 1
+    '''),
+}
+
+def rebuild_stats(database: Database = None) -> Dict[str, int]:
+    """Пересчитывает сводные таблицы с нуля; возвращает число расходившихся строк по каждой."""
+    database = database or db
+    drift = {}
+    with database.transaction() as cur:
+        for table, (key, queries) in STATS_REBUILD_QUERIES.items():
+            cur.execute(f'SELECT * FROM {table}')
+            before = {row[key]: tuple(row) for row in cur.fetchall() if not _stats_row_empty(row, key)}
+            cur.execute(f'DELETE FROM {table}')
+            for query in queries.split(';'):
+                cur.execute(query)
+            cur.execute(f'SELECT * FROM {table}')
+            after = {row[key]: tuple(row) for row in cur.fetchall()}
+            drift[table] = sum(
+                1 for k in before.keys() | after.keys()
+                if not _stats_rows_equal(before.get(k), after.get(k))
+            )
+    logger.info("Stats rebuilt, drift: %s", drift)
+    return drift
+
+def _stats_row_empty(row, key: str) -> bool:
+    return all(abs(row[k]) < 0.005 for k in row.keys() if k != key and isinstance(row[k], (int, float)))
+
+def _stats_rows_equal(a: Optional[tuple], b: Optional[tuple]) -> bool:
+    if a is None or b is None:
+        return a == b
+    return all(
+        abs(x - y) < 0.005 if isinstance(x, (int, float)) and isinstance(y, (int, float)) else x == y
+        for x, y in zip(a, b)
+    )
+
+# ============== ORDERS & DISPATCH ==============
+ORDER_STATUS_TIMESTAMPS = {
+    'paid': 'paid_at',
+    'in_progress': 'started_at',
+    'completed': 'completed_at',
+    'cancelled': 'cancelled_at',
+}
+
+# Допустимые переходы; in_progress выставляет OrderClaimQueue при первом взятии
+ORDER_STATUS_TRANSITIONS = {
+    'pending': {'paid', 'cancelled'},
+    'paid': {'in_progress', 'completed', 'cancelled'},
+    'in_progress': {'completed', 'cancelled'},
+    'completed': set(),
+    'cancelled': set(),
+}
+
+class OrderStatusError(Exception):
+    pass
+
+def set_order_status(order_id: int, status: str, database: Database = None) -> Optional[Dict]:
+    """Переводит заказ в новый статус; возвращает заказ со старым статусом в 'previous_status'."""
+    database = database or db
+    with database.transaction() as cur:
+        cur.execute('SELECT * FROM orders WHERE id=?', (order_id,))
+        order = cur.fetchone()
+        if not order or order['status'] == status:
+            return None
+        order = dict(order)
+        if status not in ORDER_STATUS_TRANSITIONS.get(order['status'], set()):
+            raise OrderStatusError(f"Нельзя перевести заказ из {order['status']} в {status}")
+
+        updated = dict(order, status=status)
+        ts_column = ORDER_STATUS_TIMESTAMPS.get(status)
+        if ts_column:
+            updated[ts_column] = now_iso()
+            cur.execute(f'UPDATE orders SET status=?, {ts_column}=? WHERE id=?', (status, updated[ts_column], order_id))
+        else:
+            cur.execute('UPDATE orders SET status=? WHERE id=?', (status, order_id))
+        apply_order_stats(cur, order, updated)
+
+        if status == 'completed':
+            cur.execute("SELECT COUNT(*) FROM order_workers WHERE order_id=? AND status='active'", (order_id,))
+            workers = cur.fetchone()[0]
+            if workers:
+                cur.execute('''
+                    UPDATE order_workers SET status='completed', completed_at=?, earnings=?
+                    WHERE order_id=? AND status='active'
+                ''', (updated['completed_at'], round((order['total'] or 0) * WORKER_PERCENT / workers, 2), order_id))
+        elif status == 'cancelled':
+            cur.execute("UPDATE order_workers SET status='cancelled' WHERE order_id=? AND status='active'", (order_id,))
+
+    updated['previous_status'] = order['status']
+    event_hub.publish(order['user_id'], 'order', {
+        'id': order_id, 'order_number': order['order_number'], 'status': status
+    })
+    return updated
+
+class OrderClaimQueue:
+    """Очередь взятия заказов исполнителями.
+
+    Нажатия на «Взять заказ» копятся CLAIM_WINDOW_MS и разбираются одной
+    транзакцией: сначала исполнители с наименьшим числом активных заказов,
+    каждое место выдаётся условным INSERT с лимитом MAX_WORKERS_PER_ORDER.
+    """
+
+    def __init__(self, database: Database, window: float = 0.3, max_workers: int = MAX_WORKERS_PER_ORDER):
+        self.db = database
+        self.window = window
+        self.max_workers = max_workers
+        self._pending: Dict[int, List[Tuple[int, Optional[str], asyncio.Future]]] = {}
+
+    async def claim(self, order_id: int, worker_id: int, username: Optional[str] = None) -> Tuple[str, int]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get(order_id)
+        if batch is None:
+            self._pending[order_id] = batch = []
+            loop.call_later(self.window, lambda: loop.create_task(self._flush(order_id)))
+        batch.append((worker_id, username, future))
+        return await future
+
+    @property
+    def pending(self) -> int:
+        return sum(len(batch) for batch in self._pending.values())
+
+    async def _flush(self, order_id: int) -> None:
+        batch = self._pending.pop(order_id, [])
+        try:
+            results, taken = await asyncio.to_thread(self.grant, order_id, [(w, u) for w, u, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for worker_id, _, future in batch:
+            if not future.done():
+                future.set_result((results[worker_id], taken))
+
+    def grant(self, order_id: int, claims: List[Tuple[int, Optional[str]]]) -> Tuple[Dict[int, str], int]:
+        """Результаты: ok / already / full / closed; плюс число занятых мест после раздачи."""
+        usernames = {}
+        for worker_id, username in claims:
+            usernames.setdefault(worker_id, username)
+        results = {}
+        started = None
+        with self.db.transaction() as cur:
+            placeholders = ','.join('?' * len(usernames))
+            cur.execute(f'''
+                SELECT worker_id, COUNT(*) FROM order_workers
+                WHERE status='active' AND worker_id IN ({placeholders})
+                GROUP BY worker_id
+            ''', tuple(usernames))
+            active = dict(cur.fetchall())
+            arrival = {worker_id: i for i, worker_id in enumerate(usernames)}
+            queue = sorted(usernames, key=lambda w: (active.get(w, 0), arrival[w]))
+
+            taken_at = now_iso()
+            for worker_id in queue:
+                cur.execute('''
+                    INSERT INTO order_workers (order_id, worker_id, worker_username, status, taken_at)
+                    SELECT ?, ?, ?, 'active', ?
+                    WHERE EXISTS (SELECT 1 FROM orders WHERE id=? AND status IN ('paid', 'in_progress'))
+                      AND NOT EXISTS (SELECT 1 FROM order_workers WHERE order_id=? AND worker_id=?)
+                      AND (SELECT COUNT(*) FROM order_workers
+                           WHERE order_id=? AND status != 'cancelled') < ?
+                ''', (order_id, worker_id, usernames[worker_id], taken_at,
+                      order_id, order_id, worker_id, order_id, self.max_workers))
+                if cur.rowcount:
+                    results[worker_id] = 'ok'
+                    continue
+                cur.execute('SELECT 1 FROM order_workers WHERE order_id=? AND worker_id=?', (order_id, worker_id))
+                if cur.fetchone():
+                    results[worker_id] = 'already'
+                    continue
+                cur.execute("SELECT 1 FROM orders WHERE id=? AND status IN ('paid', 'in_progress')", (order_id,))
+                results[worker_id] = 'full' if cur.fetchone() else 'closed'
+
+            cur.execute("SELECT COUNT(*) FROM order_workers WHERE order_id=? AND status != 'cancelled'",
+                        (order_id,))
+            taken = cur.fetchone()[0]
+            if 'ok' in results.values():
+                cur.execute("SELECT * FROM orders WHERE id=? AND status='paid'", (order_id,))
+                order = cur.fetchone()
+                if order:
+                    started = dict(order)
+                    cur.execute("UPDATE orders SET status='in_progress', started_at=? WHERE id=?", (taken_at, order_id))
+                    apply_order_stats(cur, started, dict(started, status='in_progress', started_at=taken_at))
+        if started:
+            event_hub.publish(started['user_id'], 'order', {
+                'id': order_id, 'order_number': started['order_number'], 'status': 'in_progress'
+            })
+        return results, taken
+
+claim_queue = OrderClaimQueue(db, window=CLAIM_WINDOW_MS / 1000)
+
+# ============== WORKER PAYOUTS ==============
+def settle_worker_payouts(database: Database = None) -> Dict:
+    """Сворачивает завершённые назначения в pending-выплаты и обновляет worker_balances.
+
+    Всё делается тремя set-based запросами в одной транзакции; назначение
+    после этого получает статус 'settled' и повторно не учитывается.
+    """
+    database = database or db
+    with database.transaction() as cur:
+        created_at = now_iso()
+        cur.execute('''
+            INSERT INTO worker_payouts (worker_id, order_id, amount, status, created_at)
+            SELECT worker_id, order_id, earnings, 'pending', ?
+            FROM order_workers WHERE status='completed'
+        ''', (created_at,))
+        payouts = cur.rowcount
+        cur.execute('''
+            INSERT INTO worker_balances (worker_id, worker_username, pending, paid, orders_count, updated_at)
+            SELECT worker_id, MAX(worker_username), SUM(earnings), 0, COUNT(*), ?
+            FROM order_workers WHERE status='completed'
+            GROUP BY worker_id
+            ON CONFLICT(worker_id) DO UPDATE SET
+                worker_username = COALESCE(excluded.worker_username, worker_balances.worker_username),
+                pending = worker_balances.pending + excluded.pending,
+                orders_count = worker_balances.orders_count + excluded.orders_count,
+                updated_at = excluded.updated_at
+        ''', (created_at,))
+        cur.execute("UPDATE order_workers SET status='settled' WHERE status='completed'")
+
+    if payouts:
+        logger.info("Payout settlement: %s new payouts", payouts)
+    return {'payouts': payouts}
+
+def mark_payouts_paid(worker_ids: Optional[List[int]] = None, up_to_id: Optional[int] = None,
+                      database: Database = None) -> Dict:
+    """up_to_id — последний id выплаты, который видел админ: созданные позже не трогаем."""
+    database = database or db
+    where, params = "status='pending'", ()
+    if worker_ids is not None:
+        if not worker_ids:
+            return {'payouts': 0, 'amount': 0}
+        where += f" AND worker_id IN ({','.join('?' * len(worker_ids))})"
+        params = tuple(worker_ids)
+    if up_to_id is not None:
+        where += " AND id <= ?"
+        params += (up_to_id,)
+
+    with database.transaction() as cur:
+        cur.execute(f'SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM worker_payouts WHERE {where}', params)
+        count, amount = cur.fetchone()
+        cur.execute(f'''
+            UPDATE worker_balances SET
+                pending = pending - (SELECT SUM(amount) FROM worker_payouts
+                                     WHERE {where} AND worker_id=worker_balances.worker_id),
+                paid = paid + (SELECT SUM(amount) FROM worker_payouts
+                               WHERE {where} AND worker_id=worker_balances.worker_id),
+                updated_at = ?
+            WHERE worker_id IN (SELECT worker_id FROM worker_payouts WHERE {where})
+        ''', params + params + (now_iso(),) + params)
+        cur.execute(f"UPDATE worker_payouts SET status='paid', paid_at=? WHERE {where}", (now_iso(),) + params)
+
+    return {'payouts': count, 'amount': round(amount, 2)}
+
+def last_payout_id(database: Database = None) -> int:
+    database = database or db
+    return database.fetchone('SELECT COALESCE(MAX(id), 0) AS id FROM worker_payouts')['id']
+
+def get_payout_summary(limit: int = 20, database: Database = None) -> List[Dict]:
+    database = database or db
+    return database.fetchall('''
+        SELECT * FROM worker_balances
+        WHERE pending > 0.005 OR paid > 0
+        ORDER BY pending DESC, paid DESC
+        LIMIT ?
+    ''', (limit,))
+
+# ============== EXPORTS ==============
+EXPORT_TABLES = ('orders', 'users', 'worker_payouts')
+# Ячейка с такого символа в Excel считается формулой (CSV injection)
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def _csv_safe(row) -> list:
+    # Экранируем только текст: username/имена/поля заказа пишет пользователь; числа не трогаем
+    return [f"'{v}" if isinstance(v, str) and v.startswith(_FORMULA_PREFIXES) else v for v in row]
+
+def iter_export_csv(table: str, chunk_rows: int = EXPORT_CHUNK_ROWS, database: Database = None) -> Iterator[str]:
+    """CSV таблицы кусками по chunk_rows строк; в памяти не больше одного куска.
+
+    Каждый кусок — отдельный короткий SELECT по id > последнего (keyset), а не
+    один курсор на всю выгрузку: в режиме rollback journal открытое чтение
+    держит SHARED-блокировку и не дало бы писателям закоммитить, пока
+    медленный клиент скачивает файл.
+    """
+    if table not in EXPORT_TABLES:
+        raise KeyError(table)
+    database = database or db
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    last_id = 0
+    conn = database.get_connection()
+    try:
+        cur = conn.execute(f'SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?', (last_id, chunk_rows))
+        buffer.write('\ufeff')  # BOM — чтобы Excel открыл UTF-8 с кириллицей
+        writer.writerow([column[0] for column in cur.description])
+        rows = cur.fetchall()
+        while rows:
+            writer.writerows(map(_csv_safe, rows))
+            last_id = rows[-1]['id']
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            rows = conn.execute(f'SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?',
+                                (last_id, chunk_rows)).fetchall()
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        conn.close()
+
+def write_export_parts(table: str, directory: str, part_bytes: int = EXPORT_PART_MB * 1024 * 1024) -> List[str]:
+    """Пишет выгрузку на диск частями не больше ~part_bytes; у каждой части своя строка заголовка."""
+    paths, part, header = [], None, None
+    try:
+        for chunk in iter_export_csv(table):
+            if header is None:
+                header = chunk[:chunk.index('\n') + 1]
+            if part is None:
+                paths.append(os.path.join(directory, f'{table}_{len(paths) + 1}.csv'))
+                part = open(paths[-1], 'w', encoding='utf-8', newline='')
+                if len(paths) > 1:
+                    part.write(header)
+            part.write(chunk)
+            if part.tell() >= part_bytes:
+                part.close()
+                part = None
+    finally:
+        if part:
+            part.close()
+    return paths
+
 # ============== WEBAPP STATIC FILES ==============
 
 INDEX_HTML = '''<!DOCTYPE html>
@@ -1026,29 +3289,73 @@ async function api(endpoint, options = {}) {
 }
 
 document.addEventListener('DOMContentLoaded', async () => {
-    await loadCategories();
-    await loadProducts();
-    await loadCart();
-    await loadFavorites();
+    try {
+        const data = await api('/bootstrap');
+        renderCategories(data.categories);
+        favorites = data.favorite_ids;
+        cart = data.cart.items;
+        updateCartBadge();
+        products = data.products;
+        renderProducts(products);
+    } catch (error) {
+        console.error('Bootstrap failed, loading separately:', error);
+        await loadCategories();
+        await loadFavorites();
+        await loadProducts();
+        await loadCart();
+    }
+    connectEvents();
 });
 
+async function connectEvents() {
+    if (!tg.initData || !window.EventSource) return;
+    // Токен одноразовый: при обрыве закрываем поток и переподключаемся с новым
+    let source;
+    try {
+        const { token } = await api('/events/token', { method: 'POST' });
+        source = new EventSource(`${API_URL}/events?token=${encodeURIComponent(token)}`);
+    } catch (error) {
+        setTimeout(connectEvents, 5000);
+        return;
+    }
+    source.onerror = () => {
+        source.close();
+        setTimeout(connectEvents, 5000);
+    };
+    source.addEventListener('cart', async () => {
+        await loadCart();
+        if (document.getElementById('cartModal').classList.contains('open')) renderCart();
+    });
+    source.addEventListener('order', (e) => {
+        const order = JSON.parse(e.data);
+        tg.HapticFeedback.notificationOccurred('success');
+        tg.showPopup({ title: `Заказ ${order.order_number}`, message: `Новый статус: ${order.status}`, buttons: [{ type: 'ok' }] });
+    });
+    source.addEventListener('notification', () => {
+        tg.HapticFeedback.notificationOccurred('success');
+    });
+}
+
 async function loadCategories() {
     try {
-        const categories = await api('/categories');
-        const container = document.getElementById('categoriesContainer');
-        categories.forEach(cat => {
-            const chip = document.createElement('button');
-            chip.className = 'category-chip';
-            chip.dataset.id = cat.id;
-            chip.onclick = () => selectCategory(cat.id);
-            chip.innerHTML = `${cat.emoji || '📦'} ${cat.name}`;
-            container.appendChild(chip);
-        });
+        renderCategories(await api('/categories'));
     } catch (error) {
         console.error('Failed to load categories:', error);
     }
 }
 
+function renderCategories(categories) {
+    const container = document.getElementById('categoriesContainer');
+    categories.forEach(cat => {
+        const chip = document.createElement('button');
+        chip.className = 'category-chip';
+        chip.dataset.id = cat.id;
+        chip.onclick = () => selectCategory(cat.id);
+        chip.innerHTML = `${cat.emoji || '📦'} ${cat.name}`;
+        container.appendChild(chip);
+    });
+}
+
 async function selectCategory(categoryId) {
     currentCategory = categoryId;
     document.querySelectorAll('.category-chip').forEach(chip => {
@@ -1261,8 +3568,8 @@ async function checkout() {
 
 async function loadFavorites() {
     try {
-        const data = await api('/favorites');
-        favorites = data.map(p => p.id);
+        const data = await api('/favorites/ids');
+        favorites = data.ids;
     } catch (error) {
         console.error('Failed to load favorites:', error);
     }
@@ -1366,7 +3673,7 @@ observer.observe(document.body, { subtree: true, attributes: true, attributeFilt
 
 # ============== FASTAPI SERVER ==============
 from fastapi import FastAPI, HTTPException, Request, Depends
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
@@ -1380,10 +3687,84 @@ webapp.add_middleware(
     allow_headers=["*"],
 )
 
+@webapp.on_event("startup")
+async def start_loop_watchdog():
+    if LOOP_WATCHDOG_ENABLED:
+        loop_watchdog.start('webapp')
+
+def client_ip(request: Request) -> str:
+    host = request.client.host if request.client else '-'
+    if host not in TRUSTED_PROXIES:
+        return host
+    # Справа налево, пропуская свои прокси: всё левее мог дописать сам клиент
+    forwarded = [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',') if a.strip()]
+    for addr in reversed(forwarded):
+        if addr not in TRUSTED_PROXIES:
+            return addr
+    return request.headers.get('X-Real-IP') or host
+
+@webapp.middleware("http")
+async def rate_limit_middleware(request: Request, call_next):
+    # Отсекаем до HMAC и БД: пользователь берётся только из кэша уже проверенных initData
+    # или из токена SSE; остальное считается по IP клиента (за TRUSTED_PROXIES — из X-Forwarded-For)
+    if not RATE_LIMIT_ENABLED or not request.url.path.startswith('/api/'):
+        return await call_next(request)
+    user = cached_webapp_user(request.headers.get('X-Telegram-Init-Data', ''))
+    sse = _sse_tokens.get(request.query_params.get('token', '')) if request.url.path == '/api/events' else None
+    if user and user.get('id'):
+        key = f"user:{user['id']}"
+    elif sse:
+        key = f"uid:{sse[0]}"
+    else:
+        key = f"ip:{client_ip(request)}"
+    limiter = api_read_limiter if request.method in ('GET', 'HEAD', 'OPTIONS') else api_write_limiter
+    if not limiter.allow(key):
+        return JSONResponse({'detail': 'Too many requests'}, status_code=429,
+                            headers={'Retry-After': str(limiter.retry_after(key))})
+    return await call_next(request)
+
+@webapp.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    # Объявлен после лимитера — значит внешний и видит в том числе ответы 429
+    stats = [0, 0.0]
+    token = _query_stats.set(stats)
+    user = cached_webapp_user(request.headers.get('X-Telegram-Init-Data', ''))
+    log_token = log_context.set({'request_id': os.urandom(6).hex(), 'user_id': user.get('id') if user else None})
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        _query_stats.reset(token)
+        log_context.reset(log_token)
+        route = request.scope.get('route')
+        path = route.path if route else 'unmatched'
+        metrics.inc('metro_http_requests_total', (('route', path), ('method', request.method), ('status', status)))
+        metrics.observe('metro_http_request_duration_seconds', (('route', path), ('method', request.method)), elapsed)
+        if stats[0]:
+            metrics.inc('metro_http_db_queries_total', (('route', path),), stats[0])
+            metrics.inc('metro_http_db_seconds_total', (('route', path),), stats[1])
+
+@webapp.get("/metrics")
+async def metrics_endpoint(request: Request):
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
 class CartItem(BaseModel):
     product_id: int
     quantity: int = 1
 
+class PromoCheck(BaseModel):
+    code: str
+
+class NotificationsRead(BaseModel):
+    ids: Optional[List[int]] = None
+    up_to_id: Optional[int] = None
+
 async def get_current_user(request: Request):
     init_data = request.headers.get('X-Telegram-Init-Data', '')
     user = validate_webapp_data(init_data)
@@ -1396,18 +3777,19 @@ async def get_current_user(request: Request):
 async def serve_webapp():
     return HTMLResponse(content=INDEX_HTML)
 
-@webapp.get("/api/categories")
-async def get_categories():
+def fetch_categories() -> List[Dict]:
     return db.fetchall('SELECT * FROM categories WHERE is_active=1 ORDER BY sort_order')
 
-@webapp.get("/api/products")
-async def get_products(
+def fetch_products(
     category_id: Optional[int] = None,
     search: Optional[str] = None,
     sort: str = "popular",
     limit: int = 20,
     offset: int = 0
-):
+) -> List[Dict]:
+    if not search and sort in CATALOG_SORTS:
+        return catalog_index.list(category_id or None, sort, limit, offset)
+    
     query = "SELECT * FROM products WHERE is_active=1"
     params = []
     
@@ -1432,13 +3814,68 @@ async def get_products(
     
     query += f" LIMIT {limit} OFFSET {offset}"
     
-    products = db.fetchall(query, tuple(params))
-    for p in products:
-        p['photos'] = json.loads(p.get('photos') or '[]')
-        p['tags'] = json.loads(p.get('tags') or '[]')
-        p['meta'] = json.loads(p.get('meta') or '{}')
+    return [parse_product(p) for p in db.fetchall(query, tuple(params))]
+
+def fetch_cart(user_id: int) -> Dict:
+    items = db.fetchall('''
+        SELECT c.*, p.name, p.price, p.photo, p.stock
+        FROM cart c
+        JOIN products p ON c.product_id = p.id
+        WHERE c.user_id=?
+    ''', (user_id,))
     
-    return products
+    total = sum(item['price'] * item['quantity'] for item in items)
+    return {"items": items, "total": total}
+
+@webapp.get("/api/categories")
+async def get_categories():
+    return fetch_categories()
+
+@webapp.get("/api/products")
+async def get_products(
+    category_id: Optional[int] = None,
+    search: Optional[str] = None,
+    sort: str = "popular",
+    limit: int = 20,
+    offset: int = 0
+):
+    return fetch_products(category_id, search, sort, limit, offset)
+
+# Общая для всех пользователей часть bootstrap: (версия каталога, истекает, данные)
+_bootstrap_cache: Tuple[int, float, Optional[Dict]] = (-1, 0.0, None)
+
+def get_bootstrap_catalog() -> Dict:
+    global _bootstrap_cache
+    version, expires, data = _bootstrap_cache
+    if data is not None and version == catalog_version() and time.monotonic() < expires:
+        metrics.inc('metro_cache_requests_total', (('cache', 'bootstrap'), ('result', 'hit')))
+        return data
+    metrics.inc('metro_cache_requests_total', (('cache', 'bootstrap'), ('result', 'miss')))
+    version = catalog_version()
+    data = {"categories": fetch_categories(), "products": fetch_products()}
+    _bootstrap_cache = (version, time.monotonic() + BOOTSTRAP_CACHE_TTL, data)
+    return data
+
+@webapp.get("/api/bootstrap")
+async def bootstrap(user: dict = Depends(get_current_user)):
+    catalog_task = asyncio.create_task(asyncio.to_thread(get_bootstrap_catalog))
+    user_row = await asyncio.to_thread(db.fetchone, 'SELECT id FROM users WHERE tg_id=?', (user['id'],))
+    
+    if user_row:
+        cart, favorite_ids = await asyncio.gather(
+            asyncio.to_thread(fetch_cart, user_row['id']),
+            asyncio.to_thread(favorites_cache.get, user_row['id']),
+        )
+    else:
+        cart, favorite_ids = {"items": [], "total": 0}, set()
+    
+    catalog = await catalog_task
+    return {
+        **catalog,
+        "cart": cart,
+        "favorite_ids": sorted(favorite_ids),
+        "catalog_version": catalog_version(),
+    }
 
 @webapp.get("/api/products/{product_id}")
 async def get_product(product_id: int):
@@ -1449,33 +3886,27 @@ async def get_product(product_id: int):
     product['photos'] = json.loads(product.get('photos') or '[]')
     product['tags'] = json.loads(product.get('tags') or '[]')
     
-    reviews = db.fetchall('''
-        SELECT r.*, u.first_name, u.username 
-        FROM reviews r 
-        JOIN users u ON r.user_id = u.id
-        WHERE r.product_id=? AND r.is_visible=1 
-        ORDER BY r.created_at DESC LIMIT 5
-    ''', (product_id,))
-    product['reviews'] = reviews
+    product['reviews'] = fetch_reviews(product_id, limit=5)
     
     db.execute('UPDATE products SET views_count = views_count + 1 WHERE id=?', (product_id,))
     return product
 
+@webapp.get("/api/products/{product_id}/reviews")
+async def get_product_reviews(product_id: int, before_id: Optional[int] = None, limit: int = 10):
+    limit = max(1, min(limit, 50))
+    reviews = fetch_reviews(product_id, limit=limit, before_id=before_id)
+    return {
+        "items": reviews,
+        "next_before_id": reviews[-1]['id'] if len(reviews) == limit else None
+    }
+
 @webapp.get("/api/cart")
 async def get_cart(user: dict = Depends(get_current_user)):
     user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
     if not user_row:
         return {"items": [], "total": 0}
     
-    items = db.fetchall('''
-        SELECT c.*, p.name, p.price, p.photo, p.stock
-        FROM cart c
-        JOIN products p ON c.product_id = p.id
-        WHERE c.user_id=?
-    ''', (user_row['id'],))
-    
-    total = sum(item['price'] * item['quantity'] for item in items)
-    return {"items": items, "total": total}
+    return fetch_cart(user_row['id'])
 
 @webapp.post("/api/cart/add")
 async def add_to_cart(item: CartItem, user: dict = Depends(get_current_user)):
@@ -1493,6 +3924,7 @@ async def add_to_cart(item: CartItem, user: dict = Depends(get_current_user)):
         db.execute('INSERT INTO cart (user_id, product_id, quantity, added_at) VALUES (?, ?, ?, ?)',
                    (user_row['id'], item.product_id, item.quantity, now_iso()))
     
+    event_hub.publish(user_row['id'], 'cart', {'product_id': item.product_id})
     return {"success": True}
 
 @webapp.post("/api/cart/update")
@@ -1506,12 +3938,14 @@ async def update_cart(item: CartItem, user: dict = Depends(get_current_user)):
         db.execute('UPDATE cart SET quantity=? WHERE user_id=? AND product_id=?',
                    (item.quantity, user_row['id'], item.product_id))
     
+    event_hub.publish(user_row['id'], 'cart', {'product_id': item.product_id})
     return {"success": True}
 
 @webapp.delete("/api/cart/{product_id}")
 async def remove_from_cart(product_id: int, user: dict = Depends(get_current_user)):
     user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
     db.execute('DELETE FROM cart WHERE user_id=? AND product_id=?', (user_row['id'], product_id))
+    event_hub.publish(user_row['id'], 'cart', {'product_id': product_id})
     return {"success": True}
 
 @webapp.get("/api/user/profile")
@@ -1536,22 +3970,138 @@ async def get_favorites(user: dict = Depends(get_current_user)):
         WHERE f.user_id=? AND p.is_active=1
     ''', (user_row['id'],))
 
+@webapp.get("/api/favorites/ids")
+async def get_favorite_ids(user: dict = Depends(get_current_user)):
+    user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
+    if not user_row:
+        return {"ids": []}
+    return {"ids": sorted(favorites_cache.get(user_row['id']))}
+
 @webapp.post("/api/favorites/{product_id}")
 async def toggle_favorite(product_id: int, user: dict = Depends(get_current_user)):
     user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
     if not user_row:
         raise HTTPException(status_code=404, detail="User not found")
     
-    existing = db.fetchone('SELECT id FROM favorites WHERE user_id=? AND product_id=?',
-                           (user_row['id'], product_id))
+    return {"is_favorite": favorites_cache.toggle(user_row['id'], product_id)}
+
+@webapp.get("/api/admin/export/{table}")
+async def export_table(table: str, user: dict = Depends(get_current_user)):
+    if not is_admin(user['id']):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Unknown table")
+    # Синхронный генератор Starlette крутит в пуле потоков — цикл не блокируется
+    return StreamingResponse(
+        iter_export_csv(table),
+        media_type='text/csv; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename="{table}_{datetime.now():%Y%m%d_%H%M}.csv"'},
+    )
+
+# EventSource не умеет слать заголовки, а initData в query попал бы в access-лог.
+# Поэтому initData меняется POST-ом на короткий одноразовый токен потока.
+_sse_tokens: Dict[str, Tuple[int, float]] = {}
+
+@webapp.post("/api/events/token")
+async def events_token(user: dict = Depends(get_current_user)):
+    user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
+    if not user_row:
+        raise HTTPException(status_code=404, detail="User not found")
+    now = time.monotonic()
+    for stale in [t for t, (_, expires) in _sse_tokens.items() if expires < now]:
+        del _sse_tokens[stale]
+    token = secrets.token_urlsafe(24)
+    _sse_tokens[token] = (user_row['id'], now + SSE_TOKEN_TTL)
+    return {'token': token, 'expires_in': SSE_TOKEN_TTL}
+
+@webapp.get("/api/events")
+async def events_stream(request: Request, token: str = ''):
+    user_id, expires = _sse_tokens.pop(token, (None, 0))
+    if user_id is None or expires < time.monotonic():
+        raise HTTPException(status_code=401, detail="Invalid token")
     
-    if existing:
-        db.execute('DELETE FROM favorites WHERE id=?', (existing['id'],))
-        return {"is_favorite": False}
-    else:
-        db.execute('INSERT INTO favorites (user_id, product_id, added_at) VALUES (?, ?, ?)',
-                   (user_row['id'], product_id, now_iso()))
-        return {"is_favorite": True}
+    subscription = event_hub.subscribe(user_id)
+    queue = subscription[1]
+    
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event}\ndata: {data}\n\n"
+        finally:
+            event_hub.unsubscribe(user_id, subscription)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+@webapp.get("/api/notifications")
+async def get_notifications(
+    before_id: Optional[int] = None,
+    limit: int = 20,
+    user: dict = Depends(get_current_user)
+):
+    user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
+    if not user_row:
+        return {"items": [], "next_before_id": None}
+    
+    limit = max(1, min(limit, 100))
+    query = "SELECT * FROM notifications WHERE user_id=?"
+    params = [user_row['id']]
+    if before_id:
+        query += " AND id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    
+    items = db.fetchall(query, tuple(params))
+    for n in items:
+        n['data'] = json.loads(n.get('data') or '{}')
+    
+    return {
+        "items": items,
+        "next_before_id": items[-1]['id'] if len(items) == limit else None
+    }
+
+@webapp.get("/api/notifications/unread")
+async def get_notifications_unread(user: dict = Depends(get_current_user)):
+    user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
+    if not user_row:
+        return {"unread": 0}
+    return {"unread": get_unread_count(user_row['id'])}
+
+@webapp.post("/api/notifications/read")
+async def read_notifications(body: NotificationsRead, user: dict = Depends(get_current_user)):
+    user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
+    if not user_row:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    marked = mark_notifications_read(user_row['id'], ids=body.ids, up_to_id=body.up_to_id)
+    return {"marked": marked, "unread": get_unread_count(user_row['id'])}
+
+@webapp.post("/api/promo/check")
+async def check_promo(body: PromoCheck, user: dict = Depends(get_current_user)):
+    user_row = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user['id'],))
+    if not user_row:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    row = db.fetchone('''
+        SELECT COALESCE(SUM(p.price * c.quantity), 0) as subtotal
+        FROM cart c
+        JOIN products p ON c.product_id = p.id
+        WHERE c.user_id=?
+    ''', (user_row['id'],))
+    
+    try:
+        return promo_engine.quote(body.code, row['subtotal'])
+    except PromoError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # ============== TELEGRAM BOT ==============
 from telegram import (
@@ -1566,13 +4116,18 @@ from telegram import (
 )
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
     filters,
 )
+from telegram.error import BadRequest, TelegramError
+from telegram.helpers import escape_markdown
 
 # Состояния диалогов
 ADD_PRODUCT_NAME, ADD_PRODUCT_PRICE, ADD_PRODUCT_CATEGORY, ADD_PRODUCT_PHOTO, ADD_PRODUCT_DESC = range(5)
@@ -1602,6 +4157,9 @@ def get_admin_keyboard() -> ReplyKeyboardMarkup:
     ], resize_keyboard=True)
 
 def get_catalog_inline_keyboard(category_id: int = None) -> InlineKeyboardMarkup:
+    return render_cache.get(('catalog_kb', category_id), lambda: build_catalog_inline_keyboard(category_id))
+
+def build_catalog_inline_keyboard(category_id: int = None) -> InlineKeyboardMarkup:
     categories = db.fetchall('SELECT * FROM categories WHERE is_active=1 ORDER BY sort_order')
     buttons = []
     for cat in categories:
@@ -1645,6 +4203,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             INSERT INTO users (tg_id, username, first_name, last_name, registered_at, last_active, invited_by)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (user.id, user.username, user.first_name, user.last_name, now_iso(), now_iso(), referrer_id))
+        record_user_registered()
         
         db.execute('INSERT INTO analytics (event_type, user_id, data, created_at) VALUES (?, ?, ?, ?)',
                    ('registration', user.id, json.dumps({'referrer': referrer_id}), now_iso()))
@@ -1676,15 +4235,10 @@ async def catalog_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     text = "📦 **Каталог товаров**\n\nВыберите категорию:"
     await update.message.reply_text(text, parse_mode='Markdown', reply_markup=get_catalog_inline_keyboard())
 
-async def category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-    
-    cat_id = int(query.data.split(':')[1])
+def build_category_page(cat_id: int) -> Optional[Dict]:
     category = db.fetchone('SELECT * FROM categories WHERE id=?', (cat_id,))
     if not category:
-        await query.message.reply_text("Категория не найдена.")
-        return
+        return None
     
     products = db.fetchall('''
         SELECT * FROM products 
@@ -1693,22 +4247,34 @@ async def category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     ''', (cat_id,))
     
     if not products:
-        await query.message.edit_text(
-            f"{category['emoji']} **{category['name']}**\n\nВ этой категории пока нет товаров.",
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('⬅️ Назад', callback_data='catalog')]])
-        )
+        return {
+            'text': f"{category['emoji']} **{category['name']}**\n\nВ этой категории пока нет товаров.",
+            'markup': InlineKeyboardMarkup([[InlineKeyboardButton('⬅️ Назад', callback_data='catalog')]]),
+            'products': [],
+        }
+    
+    return {
+        'text': f"{category['emoji']} **{category['name']}**\n\n{category['description'] or ''}\n\nНайдено товаров: {len(products)}",
+        'markup': None,
+        'products': products[:10],
+    }
+
+async def category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    
+    cat_id = int(query.data.split(':')[1])
+    page = render_cache.get(('category', cat_id), lambda: build_category_page(cat_id))
+    if not page:
+        await query.message.reply_text("Категория не найдена.")
         return
     
-    await query.message.edit_text(
-        f"{category['emoji']} **{category['name']}**\n\n{category['description'] or ''}\n\nНайдено товаров: {len(products)}",
-        parse_mode='Markdown'
-    )
+    await query.message.edit_text(page['text'], parse_mode='Markdown', reply_markup=page['markup'])
     
-    for product in products[:10]:
+    for product in page['products']:
         await send_product_card(query.message, product, context)
 
-async def send_product_card(message, product: Dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+def render_product_card(product: Dict) -> Tuple[str, InlineKeyboardMarkup]:
     price_text = f"💰 {product['price']}₽"
     if product['old_price'] and product['old_price'] > product['price']:
         discount = int((1 - product['price'] / product['old_price']) * 100)
@@ -1745,7 +4311,10 @@ async def send_product_card(message, product: Dict, context: ContextTypes.DEFAUL
     if product['stock'] == 0:
         buttons = [[InlineKeyboardButton('🔔 Уведомить о поступлении', callback_data=f"notify_stock:{product['id']}")]]
     
-    kb = InlineKeyboardMarkup(buttons)
+    return caption, InlineKeyboardMarkup(buttons)
+
+async def send_product_card(message, product: Dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+    caption, kb = render_cache.get(('card', product['id']), lambda: render_product_card(product))
     
     if product['photo']:
         try:
@@ -1755,26 +4324,12 @@ async def send_product_card(message, product: Dict, context: ContextTypes.DEFAUL
     else:
         await message.reply_text(caption, parse_mode='Markdown', reply_markup=kb)
 
-async def product_detail_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-    
-    product_id = int(query.data.split(':')[1])
+def build_product_detail(product_id: int) -> Optional[Dict]:
     product = db.fetchone('SELECT * FROM products WHERE id=?', (product_id,))
-    
     if not product:
-        await query.message.reply_text("Товар не найден.")
-        return
-    
-    db.execute('UPDATE products SET views_count = views_count + 1 WHERE id=?', (product_id,))
+        return None
     
-    reviews = db.fetchall('''
-        SELECT r.*, u.username, u.first_name 
-        FROM reviews r 
-        JOIN users u ON r.user_id = u.tg_id 
-        WHERE r.product_id=? AND r.is_visible=1 
-        ORDER BY r.created_at DESC LIMIT 3
-    ''', (product_id,))
+    reviews = fetch_reviews(product_id, limit=3)
     
     price_text = f"💰 {product['price']}₽"
     if product['old_price'] and product['old_price'] > product['price']:
@@ -1798,11 +4353,20 @@ async def product_detail_callback(update: Update, context: ContextTypes.DEFAULT_
             text_preview = (r['text'][:50] + '...') if r['text'] and len(r['text']) > 50 else (r['text'] or '')
             caption += f"{stars} {name}: {text_preview}\n"
     
-    user = query.from_user
-    user_db = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user.id,))
-    is_fav = db.fetchone('SELECT 1 FROM favorites WHERE user_id=? AND product_id=?', 
-                         (user_db['id'], product_id)) if user_db else False
+    photos = json.loads(product['photos'] or '[]')
+    if product['photo']:
+        photos.insert(0, product['photo'])
+    
+    media = None
+    if len(photos) > 1:
+        media = [InputMediaPhoto(photos[0], caption=caption, parse_mode='Markdown')]
+        for p in photos[1:4]:
+            media.append(InputMediaPhoto(p))
     
+    return {'product': product, 'caption': caption, 'photos': photos, 'media': media}
+
+def build_product_detail_keyboard(product: Dict, is_fav: bool, admin: bool) -> InlineKeyboardMarkup:
+    product_id = product['id']
     fav_text = '💔 Убрать' if is_fav else '❤️ В избранное'
     
     buttons = [
@@ -1817,29 +4381,69 @@ async def product_detail_callback(update: Update, context: ContextTypes.DEFAULT_
         ]
     ]
     
-    if is_admin(user.id):
+    if admin:
         buttons.append([
             InlineKeyboardButton('✏️ Редактировать', callback_data=f"edit_product:{product_id}"),
             InlineKeyboardButton('🗑 Удалить', callback_data=f"delete_product:{product_id}")
         ])
     
-    kb = InlineKeyboardMarkup(buttons)
+    return InlineKeyboardMarkup(buttons)
+
+async def product_detail_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
     
-    photos = json.loads(product['photos'] or '[]')
-    if product['photo']:
-        photos.insert(0, product['photo'])
+    product_id = int(query.data.split(':')[1])
+    detail = render_cache.get(('detail', product_id), lambda: build_product_detail(product_id))
     
-    if len(photos) > 1:
-        media = [InputMediaPhoto(photos[0], caption=caption, parse_mode='Markdown')]
-        for p in photos[1:4]:
-            media.append(InputMediaPhoto(p))
-        await query.message.reply_media_group(media)
+    if not detail:
+        await query.message.reply_text("Товар не найден.")
+        return
+    
+    db.execute('UPDATE products SET views_count = views_count + 1 WHERE id=?', (product_id,))
+    
+    user = query.from_user
+    user_db = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user.id,))
+    is_fav = favorites_cache.contains(user_db['id'], product_id) if user_db else False
+    admin = is_admin(user.id)
+    
+    kb = render_cache.get(
+        ('detail_kb', product_id, is_fav, admin),
+        lambda: build_product_detail_keyboard(detail['product'], is_fav, admin)
+    )
+    
+    caption, photos = detail['caption'], detail['photos']
+    if detail['media']:
+        await query.message.reply_media_group(detail['media'])
         await query.message.reply_text('Выберите действие:', reply_markup=kb)
     elif photos:
         await query.message.reply_photo(photos[0], caption=caption, parse_mode='Markdown', reply_markup=kb)
     else:
         await query.message.reply_text(caption, parse_mode='Markdown', reply_markup=kb)
 
+async def reviews_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    
+    parts = query.data.split(':')
+    product_id = int(parts[1])
+    before_id = int(parts[2]) if len(parts) > 2 else None
+    reviews = fetch_reviews(product_id, limit=10, before_id=before_id)
+    
+    if not reviews:
+        await query.message.reply_text("Отзывов пока нет." if not before_id else "Больше отзывов нет.")
+        return
+    
+    text = "📝 **Отзывы:**\n\n"
+    for r in reviews:
+        name = escape_markdown(r['first_name'] or r['username'] or 'Аноним')
+        text += f"{'⭐' * r['rating']} {name}\n{escape_markdown(r['text'] or '')}\n\n"
+    
+    buttons = []
+    if len(reviews) == 10:
+        buttons.append([InlineKeyboardButton('Ещё ➡️', callback_data=f"reviews:{product_id}:{reviews[-1]['id']}")])
+    await query.message.reply_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(buttons) if buttons else None)
+
 async def add_to_cart_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     product_id = int(query.data.split(':')[1])
@@ -1870,15 +4474,24 @@ async def add_to_cart_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         db.execute('INSERT INTO cart (user_id, product_id, quantity, added_at) VALUES (?, ?, 1, ?)',
                    (user_db['id'], product_id, now_iso()))
         await query.answer("✅ Добавлено в корзину!")
+    
+    event_hub.publish(user_db['id'], 'cart', {'product_id': product_id})
 
-async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    user_db = db.fetchone('SELECT * FROM users WHERE tg_id=?', (user.id,))
+async def toggle_favorite_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    product_id = int(query.data.split(':')[1])
     
+    user_db = db.fetchone('SELECT id FROM users WHERE tg_id=?', (query.from_user.id,))
     if not user_db:
-        await update.message.reply_text("Ошибка. Напишите /start")
+        await query.answer("Ошибка. Напишите /start", show_alert=True)
         return
     
+    if favorites_cache.toggle(user_db['id'], product_id):
+        await query.answer("❤️ Добавлено в избранное")
+    else:
+        await query.answer("💔 Удалено из избранного")
+
+def render_cart(user_db: Dict) -> Tuple[str, InlineKeyboardMarkup]:
     cart_items = db.fetchall('''
         SELECT c.*, p.name, p.price, p.photo 
         FROM cart c 
@@ -1887,12 +4500,10 @@ async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     ''', (user_db['id'],))
     
     if not cart_items:
-        await update.message.reply_text(
+        return (
             "🛒 **Ваша корзина пуста**\n\nДобавьте товары из каталога!",
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('🛍 Открыть каталог', callback_data='catalog')]])
+            InlineKeyboardMarkup([[InlineKeyboardButton('🛍 Открыть каталог', callback_data='catalog')]])
         )
-        return
     
     total = sum(item['price'] * item['quantity'] for item in cart_items)
     
@@ -1918,7 +4529,130 @@ async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     buttons.append([InlineKeyboardButton('🗑 Очистить корзину', callback_data='cart_clear')])
     buttons.append([InlineKeyboardButton(f'✅ Оформить заказ на {total}₽', callback_data='checkout')])
 
-    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(buttons))
+    return text, InlineKeyboardMarkup(buttons)
+
+async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    user_db = db.fetchone('SELECT * FROM users WHERE tg_id=?', (user.id,))
+    
+    if not user_db:
+        await update.message.reply_text("Ошибка. Напишите /start")
+        return
+    
+    text, kb = render_cart(user_db)
+    message = await update.message.reply_text(text, parse_mode='Markdown', reply_markup=kb)
+    cart_edits.remember(message, text, kb)
+
+
+class CartEditCoalescer:
+    """Склеивает быстрые нажатия ➕/➖/🗑 одного пользователя.
+
+    Первое нажатие открывает окно CART_DEBOUNCE_MS; по его окончании все
+    изменения пишутся одной транзакцией, а сообщение корзины правится одним
+    edit_message_text — и только если отрисовка действительно изменилась.
+    """
+
+    def __init__(self, delay: float, max_messages: int = 10000):
+        self.delay = delay
+        self.max_messages = max_messages
+        self._pending: Dict[int, Dict] = {}
+        self._rendered: 'OrderedDict[Tuple[int, int], str]' = OrderedDict()
+
+    @staticmethod
+    def _signature(text: str, kb: InlineKeyboardMarkup) -> str:
+        return text + json.dumps(kb.to_dict(), ensure_ascii=False, sort_keys=True)
+
+    def remember(self, message, text: str, kb: InlineKeyboardMarkup) -> None:
+        key = (message.chat_id, message.message_id)
+        self._rendered[key] = self._signature(text, kb)
+        self._rendered.move_to_end(key)
+        while len(self._rendered) > self.max_messages:
+            self._rendered.popitem(last=False)
+
+    def forget(self, message) -> None:
+        self._rendered.pop((message.chat_id, message.message_id), None)
+
+    max_attempts = 3
+
+    def _open(self, user_id: int, message) -> Dict:
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = {'deltas': {}, 'removed': set(), 'message': message, 'attempts': 0}
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.delay, lambda: loop.create_task(self.flush(user_id)))
+        pending['message'] = message
+        return pending
+
+    def _requeue(self, user_id: int, failed: Dict) -> None:
+        # Неудачная пачка старше новых нажатий: её удаления по-прежнему побеждают
+        pending = self._open(user_id, self._pending.get(user_id, failed)['message'])
+        pending['attempts'] = max(pending['attempts'], failed['attempts'] + 1)
+        pending['removed'] |= failed['removed']
+        for product_id, delta in failed['deltas'].items():
+            pending['deltas'][product_id] = pending['deltas'].get(product_id, 0) + delta
+        for product_id in pending['removed']:
+            pending['deltas'].pop(product_id, None)
+
+    def add(self, user_id: int, message, product_id: int, delta: Optional[int]) -> None:
+        """delta=None — удалить позицию целиком."""
+        pending = self._open(user_id, message)
+        if delta is None:
+            pending['removed'].add(product_id)
+            pending['deltas'].pop(product_id, None)
+        elif product_id not in pending['removed']:
+            pending['deltas'][product_id] = pending['deltas'].get(product_id, 0) + delta
+
+    def discard(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @staticmethod
+    def _write(user_id: int, pending: Dict) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+        if pending['removed'] or any(pending['deltas'].values()):
+            apply_cart_edits(user_id, pending['deltas'], pending['removed'])
+            event_hub.publish(user_id, 'cart', {})
+        user_db = db.fetchone('SELECT * FROM users WHERE id=?', (user_id,))
+        return render_cart(user_db) if user_db else None
+
+    async def flush(self, user_id: int) -> None:
+        pending = self._pending.pop(user_id, None)
+        if pending is None:
+            return
+        message = pending['message']
+        try:
+            rendered = await asyncio.to_thread(self._write, user_id, pending)
+        except Exception as e:
+            logger.warning("Cart flush for user %s failed (attempt %s): %s", user_id, pending['attempts'] + 1, e)
+            if pending['attempts'] + 1 < self.max_attempts:
+                self._requeue(user_id, pending)
+                return
+            try:
+                await message.reply_text("⚠️ Не удалось сохранить изменения корзины, попробуйте ещё раз.")
+            except TelegramError:
+                pass
+            return
+        if rendered is None:
+            return
+        text, kb = rendered
+        signature = self._signature(text, kb)
+        if self._rendered.get((message.chat_id, message.message_id)) == signature:
+            return
+        try:
+            await message.edit_text(text, parse_mode='Markdown', reply_markup=kb)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning("Cart edit failed: %s", e)
+                return
+        except TelegramError as e:
+            # В БД всё уже записано; сообщение догонит следующая правка
+            logger.warning("Cart edit failed: %s", e)
+            return
+        self.remember(message, text, kb)
+
+cart_edits = CartEditCoalescer(CART_DEBOUNCE_MS / 1000)
 
 
 # === Обработка нажатий на кнопки: ➕➖🗑 и Очистить ===
@@ -1926,37 +4660,25 @@ async def cart_update_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     data = query.data
     await query.answer()
+    if data == "noop":
+        return  # ничего не делаем
+
     user = query.from_user
     user_db = db.fetchone('SELECT id FROM users WHERE tg_id=?', (user.id,))
     if not user_db:
         return
 
-    if data.startswith("cart_minus:"):
-        product_id = int(data.split(":")[1])
-        item = db.fetchone('SELECT quantity FROM cart WHERE user_id=? AND product_id=?', (user_db['id'], product_id))
-        if item:
-            if item['quantity'] <= 1:
-                db.execute('DELETE FROM cart WHERE user_id=? AND product_id=?', (user_db['id'], product_id))
-            else:
-                db.execute('UPDATE cart SET quantity=quantity-1 WHERE user_id=? AND product_id=?', (user_db['id'], product_id))
-        await cart_handler(update, context)
-
-    elif data.startswith("cart_plus:"):
-        product_id = int(data.split(":")[1])
-        db.execute('UPDATE cart SET quantity=quantity+1 WHERE user_id=? AND product_id=?', (user_db['id'], product_id))
-        await cart_handler(update, context)
-
-    elif data.startswith("cart_remove:"):
-        product_id = int(data.split(":")[1])
-        db.execute('DELETE FROM cart WHERE user_id=? AND product_id=?', (user_db['id'], product_id))
-        await cart_handler(update, context)
-
-    elif data == "cart_clear":
+    if data == "cart_clear":
+        cart_edits.discard(user_db['id'])
         db.execute('DELETE FROM cart WHERE user_id=?', (user_db['id'],))
+        event_hub.publish(user_db['id'], 'cart', {})
+        cart_edits.forget(query.message)
         await query.message.edit_text("🗑 Корзина очищена!")
+        return
 
-    elif data == "noop":
-        pass  # ничего не делаем
+    action, product_id = data.split(":")
+    delta = {'cart_minus': -1, 'cart_plus': 1, 'cart_remove': None}[action]
+    cart_edits.add(user_db['id'], query.message, int(product_id), delta)
 
 
 # === Хендлер на callback "checkout" (оформление заказа) ===
@@ -1966,21 +4688,543 @@ async def checkout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.message.reply_text("✅ Для оформления заказа перейдите в WebApp и нажмите «Оформить заказ» внутри корзины.", reply_markup=get_main_menu(query.from_user.id))
 
 
-# === РЕГИСТРАЦИЯ ВСЕХ ХЕНДЛЕРОВ В ПРИЛОЖЕНИИ ===
-def build_bot_app():
-    app = ApplicationBuilder().token(TG_BOT_TOKEN).build()
+# === Раздача оплаченных заказов исполнителям ===
+ORDER_STATUS_COMMANDS = {'paid': 'paid', 'done': 'completed', 'cancel': 'cancelled'}
+
+CLAIM_RESULT_TEXT = {
+    'ok': '✅ Заказ закреплён за вами!',
+    'already': 'Вы уже взяли этот заказ.',
+    'full': '😔 Все места на этом заказе заняты.',
+    'closed': 'Заказ больше недоступен.',
+    'forbidden': 'Брать заказы могут только исполнители.',
+    'error': '⚠️ Не удалось взять заказ, попробуйте ещё раз.',
+}
+
+def get_claim_keyboard(order_id: int, taken: int) -> Optional[InlineKeyboardMarkup]:
+    if taken >= MAX_WORKERS_PER_ORDER:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(
+        f'🙋 Взять заказ ({taken}/{MAX_WORKERS_PER_ORDER})', callback_data=f"claim:{order_id}"
+    )]])
+
+async def post_order_to_workers(bot, order: Dict) -> None:
+    items = json.loads(order['items'] or '[]')
+    items_text = '\n'.join(
+        f"• {item.get('name', 'Товар')} × {item.get('quantity', 1)}" for item in items if isinstance(item, dict)
+    )
+    total = order['total'] or 0
+    text = (
+        f"🆕 **Заказ {order['order_number']}**\n\n"
+        f"{items_text}\n\n"
+        f"💰 Сумма: {total}₽\n"
+        f"🎮 PUBG ID: {order['pubg_id'] or '—'}\n"
+        f"💵 Исполнителям: {round(total * WORKER_PERCENT, 2)}₽ (до {MAX_WORKERS_PER_ORDER} чел.)"
+    )
+    await bot.send_message(ADMIN_CHAT_ID, text, parse_mode='Markdown', reply_markup=get_claim_keyboard(order['id'], 0))
+
+async def claim_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    order_id = int(query.data.split(':')[1])
+    user = query.from_user
+
+    if not is_worker(user.id):
+        result, taken = 'forbidden', 0
+    else:
+        try:
+            result, taken = await claim_queue.claim(order_id, user.id, user.username)
+        except Exception as e:
+            logger.error("Claim of order %s by %s failed: %s", order_id, user.id, e)
+            result, taken = 'error', 0
+    await query.answer(CLAIM_RESULT_TEXT[result], show_alert=result != 'ok')
+
+    if result == 'ok':
+        try:
+            await query.message.edit_reply_markup(get_claim_keyboard(order_id, taken))
+        except Exception:
+            pass
+
+async def order_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+
+    command = update.message.text.split()[0].lstrip('/').split('@')[0]
+    status = ORDER_STATUS_COMMANDS[command]
+    if not context.args:
+        await update.message.reply_text(f"Использование: /{command} <номер заказа>")
+        return
+
+    order = db.fetchone('SELECT id FROM orders WHERE order_number=?', (context.args[0],))
+    if not order:
+        await update.message.reply_text("Заказ не найден.")
+        return
+
+    try:
+        changed = set_order_status(order['id'], status)
+    except OrderStatusError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    if not changed:
+        await update.message.reply_text("Статус заказа не изменился.")
+        return
+
+    if status == 'paid':
+        await post_order_to_workers(context.bot, changed)
+
+    await update.message.reply_text(f"✅ Заказ {changed['order_number']}: {changed['previous_status']} → {status}")
+
+
+# === Статистика (админ) ===
+ORDER_STATUS_LABELS = {
+    'pending': '⏳ Ожидают оплаты',
+    'paid': '💳 Оплачены',
+    'in_progress': '⚙️ В работе',
+    'completed': '✅ Выполнены',
+    'cancelled': '❌ Отменены',
+}
+
+def render_stats() -> str:
+    snapshot = get_stats_snapshot()
+    today = now_iso()[:10]
+    days = snapshot['days']
+    today_row = next((d for d in days if d['day'] == today), None)
+
+    text = "📊 **Статистика**\n\n"
+    text += f"**Сегодня:** {round(today_row['revenue'], 2) if today_row else 0}₽ • "
+    text += f"заказов {today_row['orders_count'] if today_row else 0} • "
+    text += f"новых пользователей {today_row['new_users'] if today_row else 0}\n"
+    text += f"**За 7 дней:** {round(sum(d['revenue'] for d in days), 2)}₽ • "
+    text += f"заказов {sum(d['orders_count'] for d in days)} • "
+    text += f"новых пользователей {sum(d['new_users'] for d in days)}\n"
+
+    if snapshot['statuses']:
+        text += "\n**Заказы по статусам:**\n"
+        for row in snapshot['statuses']:
+            label = ORDER_STATUS_LABELS.get(row['status'], escape_markdown(row['status'] or '—'))
+            text += f"{label}: {row['orders_count']} ({round(row['amount'], 2)}₽)\n"
+
+    if snapshot['top_products']:
+        text += "\n**Топ товаров:**\n"
+        for i, row in enumerate(snapshot['top_products'], 1):
+            name = escape_markdown(row['name'] or f"#{row['product_id']}")
+            text += f"{i}. {name} — {row['quantity']} шт. / {round(row['revenue'], 2)}₽\n"
+
+    return text
+
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    await update.message.reply_text(render_stats(), parse_mode='Markdown')
+
+async def stats_rebuild_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    drift = await asyncio.to_thread(rebuild_stats)
+    lines = '\n'.join(f"• {table}: {count}" for table, count in drift.items())
+    await update.message.reply_text(f"♻️ Статистика пересчитана. Расхождений (строк):\n{lines}")
+
+
+async def ratings_rebuild_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    fixed = await asyncio.to_thread(rebuild_ratings)
+    await update.message.reply_text(f"⭐ Рейтинги пересчитаны. Исправлено товаров: {fixed}")
 
+
+async def db_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    report = await asyncio.to_thread(db_size_report)
+    backup = await asyncio.to_thread(get_backup_status)
+    last_backup = f"{backup['finished_at'][:16]} ({backup['duration_s']} с)" if backup else 'нет'
+    rows = '\n'.join(f"• {table}: {count}" for table, count in report['rows'].items())
+    await update.message.reply_text(
+        f"🗄 База данных: {report['file_bytes'] / 1024 / 1024:.1f} МБ\n"
+        f"Страниц: {report['pages']} × {report['page_size']} Б, свободно {report['free_pages']}\n"
+        f"auto_vacuum: {report['auto_vacuum']}\n"
+        f"Последний бэкап: {last_backup}\n\n"
+        f"Строк в таблицах:\n{rows}"
+    )
+
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    await update.message.reply_text("💾 Делаю снимок базы...")
+    try:
+        result = await asyncio.to_thread(backup_database)
+    except BackupError as e:
+        await update.message.reply_text(f"❌ Бэкап не выполнен: {e}")
+        return
+    await update.message.reply_text(
+        f"✅ Бэкап готов: {os.path.basename(result['path'])}\n"
+        f"Размер: {result['bytes'] / 1024 / 1024:.1f} МБ, {result['duration_s']} с\n"
+        f"Перезапусков: {result['restarts']}, удалено старых: {result['removed']}"
+    )
+
+
+async def db_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /db_queries [N] [total|count|p99|avg]  или  /db_queries reset
+    if not is_admin(update.effective_user.id):
+        return
+    args = context.args or []
+    if args[:1] == ['reset']:
+        query_profiler.reset()
+        await update.message.reply_text("🧹 Статистика запросов сброшена")
+        return
+    if not query_profiler.enabled:
+        await update.message.reply_text("Профилировщик выключен (QUERY_PROFILER_ENABLED=0)")
+        return
+    limit = int(args[0]) if args and args[0].isdigit() else 10
+    order = next((a for a in args if a in ('total', 'count', 'p99', 'avg')), 'total')
+    top = query_profiler.top(min(limit, 30), order)
+    if not top:
+        await update.message.reply_text("Запросов пока не было")
+        return
+    lines = [f"🐢 Топ-{len(top)} SQL по {order}:"]
+    for i, row in enumerate(top, 1):
+        shape = row['shape'] if len(row['shape']) <= 200 else row['shape'][:200] + '…'
+        lines.append(f"\n{i}. n={row['count']} Σ={row['total_ms']:.0f}мс avg={row['avg_ms']:.2f} "
+                     f"p99={row['p99_ms']:.2f} max={row['max_ms']:.1f}\n{shape}")
+    await update.message.reply_text('\n'.join(lines)[:4096])
+
+
+# === Выгрузки CSV (админ) ===
+EXPORT_ALIASES = {'orders': 'orders', 'users': 'users', 'payouts': 'worker_payouts', 'worker_payouts': 'worker_payouts'}
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /export orders|users|payouts
+    if not is_admin(update.effective_user.id):
+        return
+    table = EXPORT_ALIASES.get((context.args or [''])[0].lower())
+    if not table:
+        await update.message.reply_text("Использование: /export orders | users | payouts")
+        return
+
+    status = await update.message.reply_text(f"⏳ Готовлю выгрузку {table}...")
+    stamp = f"{datetime.now():%Y%m%d_%H%M}"
+    with tempfile.TemporaryDirectory(prefix='metro_export_') as tmp:
+        paths = await asyncio.to_thread(write_export_parts, table, tmp)
+        for number, path in enumerate(paths, 1):
+            suffix = f"_part{number}" if len(paths) > 1 else ''
+            with open(path, 'rb') as f:
+                await update.message.reply_document(
+                    document=f, filename=f"{table}_{stamp}{suffix}.csv",
+                    caption=f"📤 {table}" + (f" — часть {number}/{len(paths)}" if len(paths) > 1 else ''),
+                    write_timeout=120,
+                )
+    await status.delete()
+
+
+# === Импорт каталога (админ) ===
+CATALOG_IMPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+_catalog_import_lock = threading.Lock()
+
+def render_import_stats(stats: Dict, done: bool) -> str:
+    text = (f"{'✅ Импорт завершён' if done else '⏳ Импорт...'}\n"
+            f"Строк: {stats['rows']} | добавлено {stats['inserted']} | обновлено {stats['updated']} | "
+            f"пропущено {stats['skipped']}")
+    if stats['categories_created']:
+        text += f"\nНовых категорий: {stats['categories_created']}"
+    if done and stats['errors']:
+        text += "\n\nОшибки:\n" + '\n'.join(stats['errors'][:10])
+    return text
+
+async def catalog_import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    await update.message.reply_text(
+        "📥 Пришлите файл .csv или .jsonl с подписью /import\n\n"
+        "Поля: name, price, category (название) или category_id; необязательные: id, old_price, "
+        "short_description, description, photo, photos (через |), stock, is_active, is_featured, "
+        "sort_order, tags (через запятую).\n"
+        "Существующий товар ищется по id или по названию в категории и обновляется."
+    )
+
+async def catalog_import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    document = update.message.document
+    fmt = CATALOG_IMPORT_FORMATS.get(os.path.splitext(document.file_name or '')[1].lower())
+    if not fmt:
+        await update.message.reply_text("❌ Нужен файл .csv или .jsonl")
+        return
+    if not _catalog_import_lock.acquire(blocking=False):
+        await update.message.reply_text("⏳ Уже идёт другой импорт, дождитесь его окончания")
+        return
+
+    try:
+        status = await update.message.reply_text("⏳ Загружаю файл...")
+        loop = asyncio.get_running_loop()
+        last_report = [0.0]
+
+        def progress(stats: Dict) -> None:
+            # Вызывается из рабочего потока; правим сообщение не чаще раза в 2 секунды
+            if time.monotonic() - last_report[0] >= 2:
+                last_report[0] = time.monotonic()
+                asyncio.run_coroutine_threadsafe(status.edit_text(render_import_stats(stats, False)), loop)
+
+        def run(path: str) -> Dict:
+            with open(path, encoding='utf-8-sig', newline='') as stream:
+                return import_catalog(stream, fmt, progress)
+
+        with tempfile.TemporaryDirectory(prefix='metro_import_') as tmp:
+            path = os.path.join(tmp, f'import.{fmt}')
+            await (await document.get_file()).download_to_drive(path)
+            started = time.monotonic()
+            stats = await asyncio.to_thread(run, path)
+        logger.info("Catalog import by %s: %s rows, +%s ~%s skipped %s in %.1fs", update.effective_user.id,
+                    stats['rows'], stats['inserted'], stats['updated'], stats['skipped'], time.monotonic() - started)
+        await status.edit_text(render_import_stats(stats, True) + f"\n⏱ {time.monotonic() - started:.1f} с")
+    except (CatalogImportError, UnicodeDecodeError, csv.Error, sqlite3.Error) as e:
+        await update.message.reply_text(f"❌ Импорт прерван: {e}\nУже записанные пачки сохранены.")
+    finally:
+        _catalog_import_lock.release()
+
+
+# === Выплаты исполнителям (админ) ===
+def render_payouts() -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    # Граница снимка в кнопках: «Выплачено» не заденет выплаты, появившиеся после показа
+    up_to = last_payout_id()
+    summary = get_payout_summary()
+    if not summary:
+        return "💰 **Выплаты**\n\nНачислений пока нет.", None
+
+    text = "💰 **Выплаты исполнителям**\n\n"
+    buttons = []
+    total_pending = 0
+    for row in summary:
+        name = f"@{row['worker_username']}" if row['worker_username'] else str(row['worker_id'])
+        text += f"• {escape_markdown(name)}: к выплате {round(row['pending'], 2)}₽ | выплачено {round(row['paid'], 2)}₽ | заказов {row['orders_count']}\n"
+        if row['pending'] > 0.005:
+            total_pending += row['pending']
+            buttons.append([InlineKeyboardButton(f"✅ Выплачено: {name}", callback_data=f"payout:{row['worker_id']}:{up_to}")])
+
+    text += f"\n━━━━━━━━━━━━━━━\n💵 **Всего к выплате: {round(total_pending, 2)}₽**"
+    if buttons:
+        buttons.append([InlineKeyboardButton('✅ Отметить все выплаченными', callback_data=f'payout:all:{up_to}')])
+    return text, InlineKeyboardMarkup(buttons) if buttons else None
+
+async def payouts_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    await asyncio.to_thread(settle_worker_payouts)
+    text, kb = await asyncio.to_thread(render_payouts)
+    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=kb)
+
+async def payout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer()
+        return
+
+    parts = query.data.split(':')
+    if len(parts) < 3:
+        # Кнопка старого формата без границы снимка — только обновляем список
+        await query.answer("Список обновлён, проверьте суммы ещё раз")
+    else:
+        target, up_to = parts[1], int(parts[2])
+        result = await asyncio.to_thread(
+            mark_payouts_paid, None if target == 'all' else [int(target)], up_to)
+        await query.answer(f"Отмечено выплат: {result['payouts']} на {result['amount']}₽")
+    text, kb = await asyncio.to_thread(render_payouts)
+    try:
+        await query.message.edit_text(text, parse_mode='Markdown', reply_markup=kb)
+    except Exception:
+        pass
+
+
+# === ФОНОВЫЕ ЗАДАЧИ ===
+BACKGROUND_JOBS = [
+    ('referral_accrual', accrue_referral_rewards, REFERRAL_ACCRUAL_INTERVAL),
+    ('payout_settlement', settle_worker_payouts, PAYOUT_SETTLEMENT_INTERVAL),
+    ('analytics_rollup', rollup_analytics, ANALYTICS_ROLLUP_INTERVAL),
+    ('analytics_compaction', compact_analytics, ANALYTICS_COMPACT_INTERVAL),
+    ('catalog_reload', catalog_index.reload, CATALOG_RELOAD_INTERVAL),
+    ('db_backup', backup_database, BACKUP_INTERVAL),
+]
+
+async def run_periodic(name: str, func, interval: int) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(func)
+        except Exception as e:
+            logger.error("Background job %s failed: %s", name, e)
+
+async def on_startup(application) -> None:
+    if LOOP_WATCHDOG_ENABLED:
+        loop_watchdog.start('bot')
+    for name, func, interval in BACKGROUND_JOBS:
+        if interval > 0:
+            application.create_task(run_periodic(name, func, interval))
+
+
+# === ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ===
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных пользователей обрабатываются параллельно (не больше limit),
+    апдейты одного чата — строго по очереди, в порядке поступления.
+
+    Нажатия кнопок упорядочиваются по пользователю, а не по чату: иначе все
+    «Взять заказ» в общем чате исполнителей шли бы друг за другом.
+
+    Семафор берётся уже после очереди пользователя: десяток нажатий одного
+    человека не занимает слоты, пока ждёт своей очереди.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__(max_concurrent_updates=limit)
+        self.limit = limit
+        self._slots = asyncio.Semaphore(limit)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+
+    async def process_update(self, update: object, coroutine) -> None:
+        # Базовая реализация берёт свой семафор ДО do_process_update, то есть до
+        # очереди ключа: ожидающие нажатия одного пользователя съели бы все слоты.
+        # Поэтому обходим его; тот же лимит держит _slots, взятый после блокировки ключа.
+        await self.do_process_update(update, coroutine)
+
+    @staticmethod
+    def update_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.callback_query:
+                return update.callback_query.from_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    @property
+    def pending(self) -> int:
+        return sum(self._waiting.values())
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self.update_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ НАЖАТИЙ ===
+async def callback_rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Группа -1: срабатывает раньше всех хендлеров, до любых запросов к БД
+    query = update.callback_query
+    if not RATE_LIMIT_ENABLED or not query:
+        return
+    if not bot_callback_limiter.allow(f"tg:{query.from_user.id}"):
+        await query.answer("⏳ Слишком часто, подождите секунду")
+        raise ApplicationHandlerStop
+
+
+# === МЕТРИКИ ХЕНДЛЕРОВ ===
+def timed_callback(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        stats = [0, 0.0]
+        token = _query_stats.set(stats)
+        user = getattr(update, 'effective_user', None)
+        log_token = log_context.set({'update_id': getattr(update, 'update_id', None),
+                                     'user_id': user.id if user else None})
+        start = time.perf_counter()
+        result = 'error'
+        try:
+            value = await callback(update, context)
+            result = 'ok'
+            return value
+        except ApplicationHandlerStop:
+            result = 'stop'
+            raise
+        finally:
+            _query_stats.reset(token)
+            log_context.reset(log_token)
+            labels = (('handler', name),)
+            metrics.observe('metro_bot_handler_duration_seconds', labels, time.perf_counter() - start)
+            metrics.inc('metro_bot_handler_calls_total', labels + (('result', result),))
+            if stats[0]:
+                metrics.inc('metro_bot_handler_db_queries_total', labels, stats[0])
+
+    return wrapper
+
+def instrument_handlers(app) -> None:
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if getattr(handler, 'callback', None):
+                handler.callback = timed_callback(handler.callback)
+
+
+# === РЕГИСТРАЦИЯ ВСЕХ ХЕНДЛЕРОВ В ПРИЛОЖЕНИИ ===
+def build_bot_app(request=None, get_updates_request=None):
+    # request/get_updates_request — свои BaseRequest вместо HTTP к Telegram (нагрузочные прогоны)
+    processor = PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES)
+    builder = ApplicationBuilder().token(TG_BOT_TOKEN).post_init(on_startup).concurrent_updates(processor)
+    if request:
+        builder = builder.request(request)
+    if get_updates_request:
+        builder = builder.get_updates_request(get_updates_request)
+    app = builder.build()
+
+    app.add_handler(TypeHandler(Update, callback_rate_limit), group=-1)
     app.add_handler(CommandHandler('start', start))
+    app.add_handler(MessageHandler(filters.Regex(r"^🛒 Корзина$"), cart_handler))
 
     app.add_handler(CallbackQueryHandler(category_callback, pattern=r"^cat:"))
     app.add_handler(CallbackQueryHandler(product_detail_callback, pattern=r"^product:"))
     app.add_handler(CallbackQueryHandler(add_to_cart_callback, pattern=r"^add_cart:"))
+    app.add_handler(CallbackQueryHandler(toggle_favorite_callback, pattern=r"^toggle_fav:"))
+    app.add_handler(CallbackQueryHandler(reviews_callback, pattern=r"^reviews:"))
     app.add_handler(CallbackQueryHandler(checkout_callback, pattern=r"^checkout$"))
+    app.add_handler(CallbackQueryHandler(claim_order_callback, pattern=r"^claim:"))
+    app.add_handler(CommandHandler(list(ORDER_STATUS_COMMANDS), order_status_command))
+    app.add_handler(MessageHandler(filters.Regex(r"^💰 Выплаты$"), payouts_handler))
+    app.add_handler(MessageHandler(filters.Regex(r"^📊 Статистика$"), stats_handler))
+    app.add_handler(CommandHandler('stats', stats_handler))
+    app.add_handler(CommandHandler('payouts', payouts_handler))
+    app.add_handler(CommandHandler('stats_rebuild', stats_rebuild_command))
+    app.add_handler(CommandHandler('ratings_rebuild', ratings_rebuild_command))
+    app.add_handler(CommandHandler('db_report', db_report_command))
+    app.add_handler(CommandHandler('backup', backup_command))
+    app.add_handler(CommandHandler('db_queries', db_queries_command))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import'), catalog_import_document))
+    app.add_handler(CommandHandler('import', catalog_import_command))
+    app.add_handler(CommandHandler('export', export_command))
+    app.add_handler(CallbackQueryHandler(payout_callback, pattern=r"^payout:"))
 
     app.add_handler(CallbackQueryHandler(cart_update_callback, pattern=r"^cart_(minus|plus|remove):"))
     app.add_handler(CallbackQueryHandler(cart_update_callback, pattern=r"^cart_clear$"))
     app.add_handler(CallbackQueryHandler(cart_update_callback, pattern=r"^noop$"))
 
+    instrument_handlers(app)
+
+    @metrics.collector
+    def collect_bot_queues():
+        yield 'metro_queue_depth', (('queue', 'bot_updates'),), app.update_queue.qsize()
+        yield 'metro_queue_depth', (('queue', 'bot_user_waiting'),), processor.pending
+        yield 'metro_queue_depth', (('queue', 'cart_edits'),), cart_edits.pending
+        yield 'metro_queue_depth', (('queue', 'order_claims'),), claim_queue.pending
 
     return app
 
@@ -1988,7 +5232,8 @@ def build_bot_app():
 # === ЗАПУСК ВЕБ-СЕРВЕРА И БОТА ===
 def run_webapp():
     import uvicorn
-    uvicorn.run(webapp, host=WEBAPP_HOST, port=WEBAPP_PORT, log_level="info")
+    # log_config=None: логгеры uvicorn идут через общую очередь и сэмплирование
+    uvicorn.run(webapp, host=WEBAPP_HOST, port=WEBAPP_PORT, log_level="info", log_config=None)
 
 def run_bot():
     application = build_bot_app()